@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks matterport-dl.py without touching the real service.
+A local stand-in for my.matterport.com, static.matterport.com and cdn-*.matterport.com serves a synthetic tour (with configurable latency, bandwidth and error/404 rates),
+a tour is downloaded from it with the chosen concurrency settings and then replayed under load through the built in webserver.
+Usage is running this program with any of the options printed by --help.
+'''
+
+import requests
+import requests.adapters
+import importlib.util
+import json
+import threading
+import functools
+import random
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# the downloader has a dash in its file name so it can't be imported the normal way
+spec = importlib.util.spec_from_file_location("matterport_dl", os.path.join(os.path.dirname(os.path.abspath(__file__)), "matterport-dl.py"))
+mpdl = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = mpdl #so worker processes can unpickle its functions
+spec.loader.exec_module(mpdl)
+
+PAGE_ID = "BenchTour001"
+ACCESS_ID = "benchaccess"
+MODEL_UUID = "benchuuid"
+
+class MockConfig:
+    def __init__(self, sweeps=20, resolutions=("512", "1k", "2k"), textures=12, tile_size=40*1024, texture_size=200*1024, asset_size=8*1024,
+            latency=0.02, bandwidth=0, error_rate=0.0, missing_rate=0.0, seed=1):
+        self.sweeps = sweeps
+        self.resolutions = list(resolutions)
+        self.textures = textures
+        self.tile_size = tile_size
+        self.texture_size = texture_size
+        self.asset_size = asset_size
+        self.latency = latency #seconds before each response starts
+        self.bandwidth = bandwidth #bytes per second per response, 0 for unlimited
+        self.error_rate = error_rate #chance of a 503 on any request
+        self.missing_rate = missing_rate #chance a static asset, image or info file 404s
+        self.seed = seed
+
+def jpegBody(size):
+    return b'\xff\xd8' + b'\x00' * max(0, size - 4) + b'\xff\xd9'
+
+def sweepIds(config):
+    return [f"sweep{i:04d}" for i in range(config.sweeps)]
+
+def prefetchedModelData(config):
+    # enough of MP_PREFETCHED_MODELDATA for planSweepTiles and the advanced texture download
+    cdn = f"https://cdn-1.matterport.com/models/{ACCESS_ID}/assets"
+    locations = []
+    for sweep in sweepIds(config):
+        skyboxes = [{"resolution": res, "tileUrlTemplate": f"{cdn}/~/tiles/{sweep}/{res}_face<face>_<x>_<y>.jpg?t=2-bench-0"} for res in config.resolutions]
+        locations.append({"pano": {"sweepUuid": sweep, "skyboxes": skyboxes}})
+    return {"queries": {"GetModelPrefetch": {"data": {"model": {"locations": locations,
+        "assets": {"meshes": [{"url": f"{cdn}/{MODEL_UUID}_50k.dam?t=2-bench-0"}],
+            "textures": [{"quality": "high", "urlTemplate": f"{cdn}/{MODEL_UUID}_50k_texture_jpg_high/{MODEL_UUID}_50k_<texture>.jpg?t=2-bench-0"}]}}}}}}
+
+class MockMatterportHandler(BaseHTTPRequestHandler):
+    # Requests arrive as /<original host>/<original path> (see MockAdapter), the host picks which of the Matterport services we are pretending to be
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body=b"", content_type="application/octet-stream", headers=None):
+        mock = self.server.mock
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if mock.config.bandwidth:
+            chunk_size = max(1024, mock.config.bandwidth // 20)
+            for offset in range(0, len(body), chunk_size):
+                self.wfile.write(body[offset:offset + chunk_size])
+                time.sleep(min(chunk_size, len(body) - offset) / mock.config.bandwidth)
+        else:
+            self.wfile.write(body)
+        mock.served(code, len(body))
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.before():
+            return
+        self.reply(200, b'{"data": {"model": {"id": "' + PAGE_ID.encode() + b'"}}}', "application/json")
+
+    def before(self):
+        # latency and injected 503s, returns True if the request was already answered
+        mock = self.server.mock
+        if mock.config.latency:
+            time.sleep(mock.config.latency)
+        if mock.chance(mock.config.error_rate):
+            self.reply(503, b"", headers={"Retry-After": "0"})
+            return True
+        return False
+
+    def do_GET(self):
+        if self.before():
+            return
+        mock = self.server.mock
+        config = mock.config
+        url = urlparse(self.path)
+        host, _, path = url.path[1:].partition("/")
+        if host == "my.matterport.com":
+            if path == "show/":
+                return self.reply(200, mock.page, "text/html")
+            if re.fullmatch(rf"api/player/models/{PAGE_ID}/files", path):
+                return self.reply(200, json.dumps({"base.url": f"https://cdn-1.matterport.com/models/{ACCESS_ID}/assets/?t=2-bench2-0", "templates": ["https://cdn-1.matterport.com/?t=2-bench3-0"]}).encode(), "application/json")
+            if path == f"api/v1/player/models/{PAGE_ID}/":
+                return self.reply(200, json.dumps(mock.model_json).encode(), "application/json")
+            if mock.chance(config.missing_rate):
+                return self.reply(404)
+            return self.reply(200, b"{}", "application/json")
+        if host == "static.matterport.com":
+            if path.endswith("showcase.js"):
+                return self.reply(200, mock.showcase, "text/javascript")
+            if mock.chance(config.missing_rate):
+                return self.reply(404)
+            if path.endswith(".jpg"):
+                return self.reply(200, jpegBody(config.asset_size))
+            return self.reply(200, mock.asset)
+        if re.fullmatch(r"cdn-\d*\.matterport\.com", host):
+            match = re.search(r"/tiles/[^/]+/([0-9a-z]+)_face\d_\d+_\d+\.jpg$", path)
+            if match:
+                return self.reply(200, mock.tile) if match.group(1) in config.resolutions else self.reply(404)
+            match = re.search(r"_50k_(\d{3})\.jpg", path)
+            if match:
+                return self.reply(200, mock.texture) if int(match.group(1)) < config.textures else self.reply(404)
+            if path.endswith(".dam"):
+                return self.reply(200, b"\x0a" + b"\x00" * config.texture_size)
+            if path.endswith(".jpg"):
+                return self.reply(200, jpegBody(config.asset_size))
+        self.reply(404)
+
+class MockMatterport:
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.statuses = {}
+        self.tile = jpegBody(config.tile_size)
+        self.texture = jpegBody(config.texture_size)
+        self.asset = b"/* bench */" + b" " * config.asset_size
+        self.showcase = b'x.e(30);x.e(46);"POST";&&(!e.expires||1000*e.expires>Date.now())' + b" " * config.asset_size
+        self.model_json = {"images": [{"src": f"https://cdn-1.matterport.com/models/{ACCESS_ID}/images/{i}.jpg?t=2-bench-0"} for i in range(10)],
+            "job": {"uuid": MODEL_UUID}, "sweeps": sweepIds(config)}
+        self.page = (f'<html><head><base href="https://static.matterport.com/showcase/1.0/"></head><body><script>var asset="https://cdn-1.matterport.com/models/{ACCESS_ID}/assets/~/x.jpg?t=2-bench-0";'
+            f'window.MP_PREFETCHED_MODELDATA = {json.dumps(prefetchedModelData(config))};</script></body></html>').encode()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MockMatterportHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def chance(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def served(self, status, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class MockAdapter(requests.adapters.HTTPAdapter):
+    # Sends every https request to the mock server instead, timing each one (to response headers) against the phase that issued it
+    def __init__(self, port, recorder, **kwargs):
+        self.port = port
+        self.recorder = recorder
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        request.url = f"http://127.0.0.1:{self.port}/{url.netloc}{url.path}" + (f"?{url.query}" if url.query else "")
+        start = time.time()
+        resp = super().send(request, **kwargs)
+        self.recorder.record(time.time() - start, int(resp.headers.get("Content-Length") or 0), resp.status_code)
+        return resp
+
+class PhaseRecorder:
+    # Splits a run into phases on the downloader's "Doing something..." status messages and collects the requests made during each
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = []
+        self.current = None
+
+    def start(self, name):
+        with self.lock:
+            if self.current is not None:
+                self.current["end"] = time.time()
+            self.current = {"name": name, "start": time.time(), "end": None, "latencies": [], "bytes": 0, "statuses": {}} if name else None
+            if self.current is not None:
+                self.phases.append(self.current)
+
+    def record(self, latency, size, status):
+        with self.lock:
+            if self.current is None:
+                return
+            self.current["latencies"].append(latency)
+            self.current["bytes"] += size
+            self.current["statuses"][status] = self.current["statuses"].get(status, 0) + 1
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def summarize(name, seconds, latencies, size, statuses=None):
+    return {"name": name, "seconds": round(seconds, 3), "requests": len(latencies), "files_per_s": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "mb_per_s": round(size / seconds / 1e6, 2) if seconds else 0.0, "p50_ms": round(percentile(latencies, 50) * 1000, 1), "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "statuses": {str(k): v for k, v in sorted((statuses or {}).items())}}
+
+def printTable(title, rows):
+    print(f"\n{title}")
+    print(f"{'phase':<28}{'seconds':>9}{'requests':>10}{'files/s':>10}{'MB/s':>8}{'p50 ms':>9}{'p99 ms':>9}  statuses")
+    for row in rows:
+        print(f"{row['name'][:27]:<28}{row['seconds']:>9}{row['requests']:>10}{row['files_per_s']:>10}{row['mb_per_s']:>8}{row['p50_ms']:>9}{row['p99_ms']:>9}  {row['statuses']}")
+
+def benchDownload(mock, output_root, engine="threads", workers=32, pool_size=32, max_in_flight=64, per_host=16, retries=4):
+    recorder = PhaseRecorder()
+    transport = mpdl.Transport(pool_size=pool_size, max_concurrency=max_in_flight if engine == "async" else workers, retry_policy=mpdl.RetryPolicy(attempts=retries + 1, base_delay=0.05))
+    adapter = MockAdapter(mock.server.server_port, recorder, pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    transport.session.mount("https://", adapter)
+    scheduler = mpdl.AsyncScheduler(max_in_flight, per_host) if engine == "async" else mpdl.ThreadedScheduler(workers)
+
+    class TimedTourDownloader(mpdl.TourDownloader):
+        def status(self, message):
+            if message == "Done!":
+                recorder.start(None)
+            elif message.endswith("...") or "... access url" in message:
+                recorder.start(message.split("...")[0])
+
+    tour = TimedTourDownloader(PAGE_ID, output_root, transport, scheduler, advanced_download=True, show_progress=False)
+    start = time.time()
+    tour.download()
+    total = time.time() - start
+    recorder.start(None)
+    rows = [summarize(phase["name"], phase["end"] - phase["start"], phase["latencies"], phase["bytes"], phase["statuses"]) for phase in recorder.phases]
+    all_latencies = [latency for phase in recorder.phases for latency in phase["latencies"]]
+    statuses = {}
+    for phase in recorder.phases:
+        for status, count in phase["statuses"].items():
+            statuses[status] = statuses.get(status, 0) + count
+    rows.append(summarize("total", total, all_latencies, sum(phase["bytes"] for phase in recorder.phases), statuses))
+    return rows, tour.page_root
+
+class QuietReplayHandler(mpdl.OurSimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def benchReplay(page_root, clients=16, seconds=10, pack_path=None):
+    # Many keep-alive clients fetching a browser like mix of the archive (mostly tiles and textures, some static files and graph posts) as fast as they can
+    mpdl.GRAPH_DATA_REQ = mpdl.readGraphReqs(mpdl.GRAPH_POSTS_DIR, PAGE_ID)
+    handler = functools.partial(QuietReplayHandler, directory=page_root)
+    server = mpdl.ReplayServer(("127.0.0.1", 0), handler, root=page_root, graph_names=mpdl.GRAPH_DATA_REQ.keys(), pack_path=pack_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    paths = sorted(path for path in server.index.files if not path.endswith((".gz", ".br", ".sqlite", ".log")))
+    heavy = [path for path in paths if path.startswith("/models/")]
+    light = [path for path in paths if not path.startswith("/models/")]
+    graph_names = list(server.index.graph)
+    lock = threading.Lock()
+    latencies, sizes, statuses = [], [0], {}
+    deadline = time.time() + seconds
+
+    def client(seed):
+        chooser = random.Random(seed)
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = "gzip, br"
+        mine, size, codes = [], 0, {}
+        while time.time() < deadline:
+            roll = chooser.random()
+            start = time.time()
+            if roll < 0.05 and graph_names:
+                resp = session.post(base + "/api/mp/models/graph", json={"operationName": chooser.choice(graph_names)})
+            else:
+                resp = session.get(base + chooser.choice(heavy if roll < 0.8 and heavy else light or heavy))
+            body = resp.content
+            mine.append(time.time() - start)
+            size += len(body)
+            codes[resp.status_code] = codes.get(resp.status_code, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            sizes[0] += size
+            for code, count in codes.items():
+                statuses[code] = statuses.get(code, 0) + count
+
+    start = time.time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    server.shutdown()
+    server.server_close()
+    return summarize(f"replay {clients} clients" + (" (packed)" if pack_path else ""), elapsed, latencies, sizes[0], statuses)
+
+def getCommandLineValue(name, default, convert=str):
+    value = mpdl.getCommandLineArg(name, True)
+    return convert(value) if value else default
+
+if __name__ == "__main__":
+    if mpdl.getCommandLineArg("--help", False):
+        print("Usage: matterport-bench.py [options]\n\tMock service:\n\t--sweeps 20 --resolutions 512,1k,2k --textures 12 -- size of the synthetic tour\n\t--tile-kb 40 --texture-kb 200 -- file sizes\n\t--latency-ms 20 -- delay before every response\n\t--bandwidth-kbps 0 -- per response bandwidth limit (0 is unlimited)\n\t--error-rate 0 -- fraction of requests answered with a 503\n\t--missing-rate 0 -- fraction of static/info files that 404\n\tDownload:\n\t--engine threads|async --workers 32 --pool-size 32 --max-in-flight 64 --per-host 16 --retries 4\n\t--rerun -- download a second time into the same folder to measure a manifest skip run\n\tReplay:\n\t--replay-clients 16 --replay-seconds 10 (0 to skip)\n\t--pack -- also replay from a packed zip\n\tOutput:\n\t--output DIR -- keep the downloaded tour in DIR (default a temporary folder that is removed)\n\t--json FILE -- also write the results as json")
+        sys.exit(0)
+    config = MockConfig(
+        sweeps=getCommandLineValue("--sweeps", 20, int),
+        resolutions=getCommandLineValue("--resolutions", "512,1k,2k").split(","),
+        textures=getCommandLineValue("--textures", 12, int),
+        tile_size=getCommandLineValue("--tile-kb", 40, int) * 1024,
+        texture_size=getCommandLineValue("--texture-kb", 200, int) * 1024,
+        latency=getCommandLineValue("--latency-ms", 20, float) / 1000,
+        bandwidth=getCommandLineValue("--bandwidth-kbps", 0, int) * 1024,
+        error_rate=getCommandLineValue("--error-rate", 0.0, float),
+        missing_rate=getCommandLineValue("--missing-rate", 0.0, float))
+    engine = getCommandLineValue("--engine", "threads")
+    download_settings = dict(engine=engine, workers=getCommandLineValue("--workers", 32, int), pool_size=getCommandLineValue("--pool-size", 32, int),
+        max_in_flight=getCommandLineValue("--max-in-flight", 64, int), per_host=getCommandLineValue("--per-host", 16, int), retries=getCommandLineValue("--retries", 4, int))
+    rerun = mpdl.getCommandLineArg("--rerun", False)
+    replay_clients = getCommandLineValue("--replay-clients", 16, int)
+    replay_seconds = getCommandLineValue("--replay-seconds", 10, float)
+    pack = mpdl.getCommandLineArg("--pack", False)
+    output = getCommandLineValue("--output", None)
+    json_file = getCommandLineValue("--json", None)
+    if len(sys.argv) > 1:
+        print(f"Unknown options: {' '.join(sys.argv[1:])}, see --help")
+        sys.exit(2)
+    if engine not in mpdl.DOWNLOAD_ENGINES:
+        print(f"--engine must be one of: {', '.join(mpdl.DOWNLOAD_ENGINES)}")
+        sys.exit(2)
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    output_root = output or tempfile.mkdtemp(prefix="matterport-bench-")
+    mock = MockMatterport(config)
+    results = {"config": vars(config), "download": download_settings}
+    try:
+        print(f"Mock tour: {config.sweeps} sweeps at {','.join(config.resolutions)}, {config.textures} textures, {config.latency*1000:.0f}ms latency, {config.error_rate:.1%} errors, {config.missing_rate:.1%} missing")
+        rows, page_root = benchDownload(mock, output_root, **download_settings)
+        printTable(f"Download ({engine} engine)", rows)
+        results["phases"] = rows
+        if rerun:
+            rows, page_root = benchDownload(mock, output_root, **download_settings)
+            printTable(f"Rerun ({engine} engine)", rows)
+            results["rerun_phases"] = rows
+        if replay_seconds > 0:
+            replay = [benchReplay(page_root, replay_clients, replay_seconds)]
+            if pack:
+                mpdl.packArchive(page_root, page_root + ".zip")
+                replay.append(benchReplay(page_root, replay_clients, replay_seconds, pack_path=page_root + ".zip"))
+            printTable("Replay", replay)
+            results["replay"] = replay
+        if json_file:
+            with open(json_file, "w", encoding="UTF-8") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        mock.stop()
+        if output is None:
+            shutil.rmtree(output_root, ignore_errors=True)
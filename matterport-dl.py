@@ -3,12 +3,16 @@
 '''
 Downloads virtual tours from matterport.
 Usage is either running this program with the URL/pageid as an argument or calling the initiateDownload(URL/pageid) method.
+For use as a library create a TourDownloader per tour, these share nothing process wide so many can run at once from threads.
 '''
 
 import requests
+import requests.adapters
 import json
 import threading
 import concurrent.futures
+import functools
+import queue
 import urllib.request
 from urllib.parse import urlparse
 import pathlib
@@ -18,411 +22,1647 @@ import shutil
 import sys
 import time
 import logging
+import logging.handlers
 from tqdm import tqdm
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+import socketserver
 import decimal
+import hashlib
+import sqlite3
+import tempfile
+import random
+import email.utils
+import asyncio
+import signal
+import gzip
+import zipfile
+import mmap
+import struct
+import subprocess
+try:
+    import brotli #optional, pip install brotli to also write .br sidecars
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image, features #optional, pip install pillow to also write .webp/.avif tile variants
+except ImportError:
+    Image = None
 
 
 
-# Weird hack
-accessurls = []
+MANIFEST_NAME = "download_manifest.sqlite"
 SHOWCASE_INTERNAL_NAME = "showcase-internal.js"
+TILES_OPTIMIZED_NAME = "tiles_optimized"
+GRAPH_POSTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "graph_posts")
 
 def makeDirs(dirname):
     pathlib.Path(dirname).mkdir(parents=True, exist_ok=True)
 
-def getVariants():
+TILE_RESOLUTIONS = ["512", "1k", "2k", "4k"]
+# names the prefetched model data uses for pano/skybox resolutions mapped to our tile file prefixes
+TILE_RESOLUTION_ALIASES = {"512":"512", "low":"512", "1k":"1k", "1024":"1k", "high":"1k", "2k":"2k", "2048":"2k", "4k":"4k", "4096":"4k"}
+
+def getVariants(resolutions=None):
     variants = []
-    depths = ["512", "1k", "2k", "4k"]
-    for depth in range(4):
-        z = depths[depth]
+    for depth in range(len(TILE_RESOLUTIONS)):
+        z = TILE_RESOLUTIONS[depth]
+        if resolutions is not None and z not in resolutions:
+            continue
         for x in range(2**depth):
             for y in range(2**depth):
                 for face in range(6):
                     variants.append(f"{z}_face{face}_{x}_{y}.jpg")
     return variants
 
-def downloadUUID(accessurl, uuid):
-    downloadFile(accessurl.format(filename=f'{uuid}_50k.dam'), f'{uuid}_50k.dam')
-    shutil.copy(f'{uuid}_50k.dam', f'..{os.path.sep}{uuid}_50k.dam')
-    cur_file=""
+def findTextureCount(texture_exists, limit=1000):
+    # Textures are numbered from 000 without gaps, so gallop then binary search for the first missing one with log(n) probes instead of trying each one in turn
+    if not texture_exists(0):
+        return 0
+    found, probe = 0, 1
+    while probe < limit and texture_exists(probe):
+        found = probe
+        probe *= 2
+    missing = min(probe, limit)
+    while missing - found > 1:
+        middle = (found + missing) // 2
+        if texture_exists(middle):
+            found = middle
+        else:
+            missing = middle
+    return found + 1
+
+def planSweepTiles(preload_json, sweeps, max_resolution=None, log=logging):
+    # Works out which tile resolutions each sweep actually has from MP_PREFETCHED_MODELDATA rather than asking for all of them and eating the 404s, sweeps we can't find there get every resolution up to the cap
+    allowed = TILE_RESOLUTIONS
+    if max_resolution:
+        allowed = TILE_RESOLUTIONS[:TILE_RESOLUTIONS.index(max_resolution)+1]
+    known = {}
     try:
-        for i in range(1000):
-            cur_file=accessurl.format(filename=f'{uuid}_50k_texture_jpg_high/{uuid}_50k_{i:03d}.jpg')
-            downloadFile(cur_file, f'{uuid}_50k_texture_jpg_high/{uuid}_50k_{i:03d}.jpg')
-            cur_file=accessurl.format(filename=f'{uuid}_50k_texture_jpg_low/{uuid}_50k_{i:03d}.jpg')
-            downloadFile(cur_file, f'{uuid}_50k_texture_jpg_low/{uuid}_50k_{i:03d}.jpg')
-    except Exception as ex:
-        logging.warning(f'Exception downloading file: {cur_file} of: {str(ex)}')
-        pass #very lazy and bad way to only download required files
-
-def downloadSweeps(accessurl, sweeps):
-    with tqdm(total=(len(sweeps)*len(getVariants()))) as pbar:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
-            for sweep in sweeps:
-                for variant in getVariants():
-                    pbar.update(1)
-                    executor.submit(downloadFile, accessurl.format(filename=f'tiles/{sweep}/{variant}') + "&imageopt=1", f'tiles/{sweep}/{variant}')
-                    while executor._work_queue.qsize() > 64:
-                        time.sleep(0.01)
-
-def downloadFileWithJSONPost(url, file, post_json_str, descriptor):
-    global PROXY
-    if "/" in file:
-        makeDirs(os.path.dirname(file))
-    if os.path.exists(file): #skip already downloaded files except idnex.html which is really json possibly wit hnewer access keys?
-        logging.debug(f'Skipping json post to url: {url} ({descriptor}) as already downloaded')
+        locations = preload_json["queries"]["GetModelPrefetch"]["data"]["model"]["locations"]
+    except (KeyError, TypeError):
+        locations = []
+    for location in locations:
+        pano = location.get("pano") or {}
+        sweep = pano.get("sweepUuid")
+        resolutions = set()
+        for skybox in pano.get("skyboxes") or []:
+            template = skybox.get("tileUrlTemplate")
+            if not template: #only the tiled skyboxes are fetched as tiles
+                continue
+            match = re.search(r'/tiles/([0-9a-z]+)/', template)
+            if match:
+                sweep = match.group(1)
+            resolution = TILE_RESOLUTION_ALIASES.get(str(skybox.get("tileResolution") or skybox.get("resolution")))
+            if resolution:
+                resolutions.add(resolution)
+        if not resolutions:
+            resolutions = {TILE_RESOLUTION_ALIASES[str(res)] for res in pano.get("resolutions") or [] if str(res) in TILE_RESOLUTION_ALIASES}
+        if sweep and resolutions:
+            known[sweep] = resolutions
 
-    opener = getUrlOpener(PROXY)
-    opener.addheaders.append(('Content-Type','application/json'))
+    plan = {}
+    for sweep in sweeps:
+        resolutions = [res for res in allowed if res in known.get(sweep, allowed)]
+        plan[sweep] = getVariants(resolutions)
+    log.info(f'Tile plan has {sum(len(v) for v in plan.values())} tiles for {len(sweeps)} sweeps ({len(known)} sweeps with known resolutions), blind enumeration would be {len(sweeps)*len(getVariants())}')
+    return plan
 
-    req = urllib.request.Request(url)
+def drange(x, y, jump):
+  while x < y:
+    yield float(x)
+    x += decimal.Decimal(jump)
 
-    for header in opener.addheaders: #not sure why we can't use the opener itself but it doesn't override it properly
-        req.add_header(header[0],header[1])
+class DownloadError(Exception):
+    def __init__(self, url, status_code=None, reason=None):
+        super().__init__(f'Failed to download {url} (HTTP {status_code}){": " + reason if reason else ""}')
+        self.url = url
+        self.status_code = status_code
 
-    body_bytes = bytes(post_json_str, "utf-8")
-    req.add_header('Content-Length', len(body_bytes))
-    resp = urllib.request.urlopen(req, body_bytes)
-    with open(file, 'w', encoding="UTF-8") as the_file:
-        the_file.write(resp.read().decode("UTF-8"))
-    logging.debug(f'Successfully downloaded w/ JSON post to: {url} ({descriptor}) to: {file}')
+def downloadResult(future):
+    # ok/skipped come back from downloadFile, anything raised is either a known missing file or a real failure
+    err = future.exception()
+    if err is None:
+        return future.result() or "ok"
+    if isinstance(err, DownloadError) and err.status_code == 404:
+        return "404"
+    return "failed"
 
+class TruncatedDownloadError(DownloadError):
+    pass
 
-def downloadFile(url, file, post_data=None):
-    global accessurls
-    url = GetOrReplaceKey(url,False)
+# 429/503 are the CDN telling us to slow down, the rest are worth another go after a pause
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503} #the server asking us to slow down, other errors back off less
+RETRYABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError, TruncatedDownloadError)
 
-    if "/" in file:
-        makeDirs(os.path.dirname(file))
-    if "?" in file:
-        file = file.split('?')[0]
+class RetryPolicy:
+    def __init__(self, attempts=5, base_delay=0.5, max_delay=60):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None: #the server told us how long, trust it
+            return min(self.max_delay, retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt)) #full jitter so threads don't retry in lockstep
 
-    if os.path.exists(file): #skip already downloaded files except idnex.html which is really json possibly wit hnewer access keys?
-        logging.debug(f'Skipping url: {url} as already downloaded')
-        return
+def parseRetryAfter(value):
+    if not value:
+        return None
     try:
-        _filename,headers = urllib.request.urlretrieve(url, file,None,post_data)
-        logging.debug(f'Successfully downloaded: {url} to: {file}')
-        return
-    except urllib.error.HTTPError as err:
-        logging.warning(f'URL error dling {url} of will try alt: {str(err)}')
-
-        # Try again but with different accessurls (very hacky!)
-        if "?t=" in url:
-            for accessurl in accessurls:
-                url2=""
-                try:
-                    url2=f"{url.split('?')[0]}?{accessurl}"
-                    urllib.request.urlretrieve(url2, file)
-                    logging.debug(f'Successfully downloaded through alt: {url2} to: {file}')
-                    return
-                except urllib.error.HTTPError as err:
-                    logging.warning(f'URL error alt method tried url {url2} dling of: {str(err)}')
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveConcurrency:
+    # AIMD limit on requests in flight: halved when we get throttled, cut by a quarter on other errors or when latency blows out, grows by one after a full window of clean requests
+    def __init__(self, maximum, minimum=2):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.successes = 0
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, ok, latency=None, throttled=False, log=logging):
+        with self.cond:
+            self.in_flight -= 1
+            if ok and latency is not None:
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+                self.baseline = self.latency if self.baseline is None else min(self.baseline, self.latency)
+                ok = self.latency < max(4 * self.baseline, 1.0)
+            if ok:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+            elif time.time() - self.last_decrease > 1: #one burst of failures should only count once
+                self.limit = max(self.minimum, self.limit * (0.5 if throttled else 0.75))
+                self.successes = 0
+                self.last_decrease = time.time()
+                log.warning(f'Backing off to {int(self.limit)} concurrent requests' + (" as the server is throttling" if throttled else ""))
+            self.cond.notify_all()
+
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] #seconds, the upper bounds of the per host latency histogram
+MAX_CONCURRENCY_SAMPLES = 3600
+
+class RunMetrics:
+    # What one tour's download run did: per phase timings, bytes and request outcomes, retries, per host latency histograms and in flight requests over time.
+    # Requests count towards the phase that was running when they finished, with the async engine phases overlap so later phases can include earlier phases' stragglers
+    def __init__(self, pageid):
+        self.pageid = pageid
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.phases = []
+        self.phase = None
+        self.retries = 0
+        self.skipped = 0
+        self.hosts = {}
+        self.concurrency = []
+        self.refresh = None
+        self.startPhase("Starting")
+
+    def startPhase(self, name):
+        with self.lock:
+            now = time.time()
+            if self.phase is not None:
+                self.phase["end"] = now
+            self.phase = {"name": name, "start": now, "end": None, "requests": 0, "bytes": 0, "statuses": {}}
+            self.phases.append(self.phase)
+
+    def finish(self):
+        with self.lock:
+            self.finished = self.phase["end"] = time.time()
+
+    def recordRequest(self, url, status, latency, size=0, retried=False):
+        host = urlparse(url).hostname or ""
+        with self.lock:
+            self.phase["requests"] += 1
+            self.phase["bytes"] += size
+            self.phase["statuses"][str(status)] = self.phase["statuses"].get(str(status), 0) + 1
+            if retried:
+                self.retries += 1
+            histogram = self.hosts.setdefault(host, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += latency
+            histogram["count"] += 1
+
+    def recordSkip(self):
+        with self.lock:
+            self.skipped += 1
+
+    def sampleConcurrency(self, limiter):
+        with self.lock:
+            if len(self.concurrency) >= MAX_CONCURRENCY_SAMPLES: #long runs keep every other sample rather than growing without bound
+                self.concurrency = self.concurrency[::2]
+            self.concurrency.append([round(time.time() - self.started, 1), limiter.in_flight, int(limiter.limit)])
+
+    def summary(self):
+        with self.lock:
+            now = time.time()
+            phases = [dict(phase, seconds=round((phase["end"] or now) - phase["start"], 3), statuses=dict(phase["statuses"])) for phase in self.phases]
+            statuses = {}
+            for phase in phases:
+                for status, count in phase["statuses"].items():
+                    statuses[status] = statuses.get(status, 0) + count
+            return {"tour": self.pageid, "started": self.started, "finished": self.finished, "seconds": round((self.finished or now) - self.started, 3),
+                "requests": sum(phase["requests"] for phase in phases), "bytes": sum(phase["bytes"] for phase in phases), "statuses": statuses,
+                "retries": self.retries, "skipped": self.skipped, "phases": [{key: phase[key] for key in ("name", "seconds", "requests", "bytes", "statuses")} for phase in phases],
+                "latency_buckets": LATENCY_BUCKETS, "hosts": {host: dict(histogram, buckets=list(histogram["buckets"])) for host, histogram in self.hosts.items()},
+                "concurrency": [list(sample) for sample in self.concurrency], "refresh": self.refresh}
+
+def promLabels(**labels):
+    escaped = {name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+def renderPrometheus(all_metrics):
+    # Prometheus text exposition format for any number of tours, each series labelled with its tour
+    lines = []
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{promLabels(**labels)} {value}")
+    summaries = [metrics.summary() for metrics in all_metrics]
+    family("matterport_dl_requests_total", "counter", "Requests made, by phase and HTTP status (or error)",
+        [("", {"tour": s["tour"], "phase": phase["name"], "status": status}, count) for s in summaries for phase in s["phases"] for status, count in phase["statuses"].items()])
+    family("matterport_dl_bytes_total", "counter", "Bytes downloaded, by phase",
+        [("", {"tour": s["tour"], "phase": phase["name"]}, phase["bytes"]) for s in summaries for phase in s["phases"]])
+    family("matterport_dl_phase_seconds", "gauge", "Time spent in each phase so far",
+        [("", {"tour": s["tour"], "phase": phase["name"]}, phase["seconds"]) for s in summaries for phase in s["phases"]])
+    family("matterport_dl_retries_total", "counter", "Requests retried after an error or throttling", [("", {"tour": s["tour"]}, s["retries"]) for s in summaries])
+    family("matterport_dl_skipped_total", "counter", "Files skipped as already downloaded or known missing", [("", {"tour": s["tour"]}, s["skipped"]) for s in summaries])
+    family("matterport_dl_run_seconds", "gauge", "Time since the run started, or its total once finished", [("", {"tour": s["tour"]}, s["seconds"]) for s in summaries])
+    family("matterport_dl_finished", "gauge", "1 once the run has finished", [("", {"tour": s["tour"]}, int(s["finished"] is not None)) for s in summaries])
+    family("matterport_dl_in_flight", "gauge", "Requests in flight at the last sample", [("", {"tour": s["tour"]}, s["concurrency"][-1][1]) for s in summaries if s["concurrency"]])
+    family("matterport_dl_concurrency_limit", "gauge", "Adaptive concurrency limit at the last sample", [("", {"tour": s["tour"]}, s["concurrency"][-1][2]) for s in summaries if s["concurrency"]])
+    histogram_samples = []
+    for s in summaries:
+        for host, histogram in s["hosts"].items():
+            for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                histogram_samples.append(("_bucket", {"tour": s["tour"], "host": host, "le": bound}, count))
+            histogram_samples.append(("_bucket", {"tour": s["tour"], "host": host, "le": "+Inf"}, histogram["count"]))
+            histogram_samples.append(("_sum", {"tour": s["tour"], "host": host}, round(histogram["sum"], 6)))
+            histogram_samples.append(("_count", {"tour": s["tour"], "host": host}, histogram["count"]))
+    family("matterport_dl_request_duration_seconds", "histogram", "Request latency by host", histogram_samples)
+    return "\n".join(lines) + "\n"
+
+class MetricsExporter:
+    # Publishes the metrics of every tour added to it while they run: a Prometheus /metrics endpoint on port and/or a json snapshot rewritten every interval seconds.
+    # The endpoint only listens on localhost unless another address is given
+    def __init__(self, port=None, snapshot_file=None, interval=10, address="127.0.0.1"):
+        self.all_metrics = []
+        self.lock = threading.Lock()
+        self.snapshot_file = snapshot_file
+        self.interval = interval
+        if port:
+            exporter = self
+            class MetricsHandler(SimpleHTTPRequestHandler):
+                def do_GET(self):
+                    body = renderPrometheus(exporter.metrics()).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, format, *args):
                     pass
-        logging.error(f'Failed to succeed for url {url}')
-        raise Exception
-    logging.error(f'Failed2 to succeed for url {url}')#hopefully not getting here?
-
-def downloadGraphModels(pageid):
-    global GRAPH_DATA_REQ
-    makeDirs("api/mp/models")
-
-    for key in GRAPH_DATA_REQ:
-        file_path = f"api/mp/models/graph_{key}.json"
-        downloadFileWithJSONPost("https://my.matterport.com/api/mp/models/graph",file_path, GRAPH_DATA_REQ[key], key)
-
-
-def downloadAssets(base):
-    js_files = ["browser-check",
-        "30","46","47","66","79","134","136","143","164","250","251","316","321","356","371","376","383","386","422","423",
-        "464","524","525","539","580","584","606","614","666","670","718","721","726","755","764","828","833","838","932","947"]
-    language_codes = ["af", "sq", "ar-SA", "ar-IQ", "ar-EG", "ar-LY", "ar-DZ", "ar-MA", "ar-TN", "ar-OM",
-     "ar-YE", "ar-SY", "ar-JO", "ar-LB", "ar-KW", "ar-AE", "ar-BH", "ar-QA", "eu", "bg",
-     "be", "ca", "zh-TW", "zh-CN", "zh-HK", "zh-SG", "hr", "cs", "da", "nl", "nl-BE", "en",
-     "en-US", "en-EG", "en-AU", "en-GB", "en-CA", "en-NZ", "en-IE", "en-ZA", "en-JM",
-     "en-BZ", "en-TT", "et", "fo", "fa", "fi", "fr", "fr-BE", "fr-CA", "fr-CH", "fr-LU",
-     "gd", "gd-IE", "de", "de-CH", "de-AT", "de-LU", "de-LI", "el", "he", "hi", "hu",
-     "is", "id", "it", "it-CH", "ja", "ko", "lv", "lt", "mk", "mt", "no", "pl",
-     "pt-BR", "pt", "rm", "ro", "ro-MO", "ru", "ru-MI", "sz", "sr", "sk", "sl", "sb",
-     "es", "es-AR", "es-GT", "es-CR", "es-PA", "es-DO", "es-MX", "es-VE", "es-CO",
-     "es-PE", "es-EC", "es-CL", "es-UY", "es-PY", "es-BO", "es-SV", "es-HN", "es-NI",
-     "es-PR", "sx", "sv", "sv-FI", "th", "ts", "tn", "tr", "uk", "ur", "ve", "vi", "xh",
-     "ji", "zu"]
-    font_files = ["ibm-plex-sans-100", "ibm-plex-sans-100italic", "ibm-plex-sans-200", "ibm-plex-sans-200italic", "ibm-plex-sans-300",
-    "ibm-plex-sans-300italic", "ibm-plex-sans-500", "ibm-plex-sans-500italic", "ibm-plex-sans-600", "ibm-plex-sans-600italic",
-    "ibm-plex-sans-700", "ibm-plex-sans-700italic", "ibm-plex-sans-italic", "ibm-plex-sans-regular", "mp-font", "roboto-100", "roboto-100italic",
-    "roboto-300", "roboto-300italic", "roboto-500", "roboto-500italic", "roboto-700", "roboto-700italic", "roboto-900", "roboto-900italic",
-    "roboto-italic", "roboto-regular"]
-
-    #extension assumed to be .png unless it is .svg or .jpg, for anything else place it in assets
-    image_files = ["360_placement_pin_maskH", "chrome", "Desktop-help-play-button.svg", "Desktop-help-spacebar", "edge", "escape", "exterior",
-    "exterior_hover", "firefox", "headset-cardboard", "headset-quest", "interior", "interior_hover", "matterport-logo-light.svg",
-    "mattertag-disc-128-free.v1", "mobile-help-play-button.svg", "nav_help_360", "nav_help_click_inside", "nav_help_gesture_drag",
-    "nav_help_gesture_drag_two_finger", "nav_help_gesture_pinch", "nav_help_gesture_position", "nav_help_gesture_position_two_finger",
-    "nav_help_gesture_tap", "nav_help_inside_key", "nav_help_keyboard_all", "nav_help_keyboard_left_right", "nav_help_keyboard_up_down",
-    "nav_help_mouse_click", "nav_help_mouse_drag_left", "nav_help_mouse_drag_right", "nav_help_mouse_position_left",
-    "nav_help_mouse_position_right", "nav_help_mouse_zoom", "nav_help_tap_inside", "nav_help_zoom_keys", "NoteColor", "NoteIcon", "pinAnchor",
-    "puck_256_red", "roboto-700-42_0", "safari", "scope.svg", "showcase-password-background.jpg", "surface_grid_planar_256", "tagbg", "tagmask",
-    "vert_arrows"]
-
-    assets = ["css/showcase.css", "css/unsupported_browser.css", "cursors/grab.png", "cursors/grabbing.png", "cursors/zoom-in.png",
-    "cursors/zoom-out.png", "locale/strings.json", "css/ws-blur.css"]
-
-    downloadFile(base + "js/showcase.js","js/showcase.js")
-    with open(f"js/showcase.js", "r", encoding="UTF-8") as f:
-	    showcase_cont = f.read()
-    #lets try to extract the js files it might be loading and make sure we know them
-    js_extracted = re.findall(r'\.e\(([0-9]{2,3})\)', showcase_cont)
-    js_extracted.sort()
-    for js in js_extracted:
-        if js not in js_files:
-            print(f'JS FILE EXTRACTED BUT not known, please file a github issue and tell us to add: {js}.js, will download for you though:)')
-            js_files.append(js)
-    
-
-    for image in image_files:
-        if not image.endswith(".jpg") and not image.endswith(".svg"):
-            image = image + ".png"
-        assets.append("images/" + image)
-    for js in js_files:
-        assets.append("js/" + js + ".js")
-    for f in font_files:
-        assets.extend(["fonts/" + f + ".woff", "fonts/" + f + ".woff2"])
-    for lc in language_codes:
-        assets.append("locale/messages/strings_" + lc + ".json")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            self.server = HTTPServer((address, int(port)), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if snapshot_file:
+            threading.Thread(target=self._snapshots, daemon=True).start()
+
+    def add(self, metrics):
+        with self.lock:
+            self.all_metrics.append(metrics)
+
+    def metrics(self):
+        with self.lock:
+            return list(self.all_metrics)
+
+    def writeSnapshot(self):
+        temp_file = self.snapshot_file + ".part"
+        with open(temp_file, "w", encoding="UTF-8") as f:
+            json.dump({"time": time.time(), "tours": [metrics.summary() for metrics in self.metrics()]}, f)
+        os.replace(temp_file, self.snapshot_file)
+
+    def _snapshots(self):
+        while True:
+            time.sleep(self.interval)
+            self.writeSnapshot()
+
+class Transport:
+    # The pooled keep-alive session plus the retry policy and adaptive concurrency limit every request goes through, one can be shared by any number of TourDownloaders
+    def __init__(self, proxy=False, pool_size=32, max_concurrency=32, retry_policy=None, timeout=(15, 60), validate_content=True):
+        self.session = buildSession(proxy, pool_size)
+        self.limiter = AdaptiveConcurrency(max_concurrency)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.timeout = timeout #connect, read
+        self.validate_content = validate_content
+
+    def withRetries(self, url, attempt_fn, log=logging, metrics=None, size_of=None):
+        # Waits for a slot under the adaptive limit, retries connection problems and throttling with backoff and feeds the outcome back to the limit (and every attempt to metrics)
+        for attempt in range(self.retry_policy.attempts):
+            last_attempt = attempt + 1 == self.retry_policy.attempts
+            retry_after = None
+            self.limiter.acquire()
+            start = time.time()
+            try:
+                result = attempt_fn()
+            except requests.exceptions.HTTPError as err:
+                status = err.response.status_code
+                retry = status in RETRYABLE_STATUS and not last_attempt
+                if metrics is not None:
+                    metrics.recordRequest(url, status, time.time() - start, retried=retry)
+                if status not in RETRYABLE_STATUS:
+                    self.limiter.release(True) #a 404/403 is still a healthy server
+                    raise
+                self.limiter.release(False, throttled=status in THROTTLE_STATUS, log=log)
+                if last_attempt:
+                    raise
+                retry_after = parseRetryAfter(err.response.headers.get("Retry-After"))
+                log.warning(f'HTTP {status} for {url}, retrying (attempt {attempt + 1})')
+            except RETRYABLE_ERRORS as err:
+                if metrics is not None:
+                    metrics.recordRequest(url, type(err).__name__, time.time() - start, retried=not last_attempt)
+                self.limiter.release(False, log=log)
+                if last_attempt:
+                    raise
+                log.warning(f'Error fetching {url}, retrying (attempt {attempt + 1}): {str(err)}')
+            except BaseException as err:
+                if metrics is not None:
+                    metrics.recordRequest(url, type(err).__name__, time.time() - start)
+                self.limiter.release(True)
+                raise
+            else:
+                if metrics is not None: #only a conditional fetch comes back empty, when the file hasn't changed
+                    metrics.recordRequest(url, 304 if result is None else 200, time.time() - start, size_of(result) if size_of and result is not None else 0)
+                self.limiter.release(True, time.time() - start)
+                return result
+            time.sleep(self.retry_policy.delay(attempt, retry_after))
+
+    def request(self, method, url, log=logging, metrics=None, **kwargs):
+        def attempt():
+            resp = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            resp.raise_for_status()
+            return resp
+        return self.withRetries(url, attempt, log, metrics, lambda resp: len(resp.content))
+
+    def fetchToFile(self, url, file, post_data=None, log=logging, metrics=None, headers=None, validators=None):
+        return self.withRetries(url, lambda: self.fetchToFileOnce(url, file, post_data, headers, validators), log, metrics, lambda result: result[0])
+
+    def fetchToFileOnce(self, url, file, post_data=None, headers=None, validators=None):
+        # Goes through the shared session so the connection to the host is reused, body is only written once we know the request succeeded.
+        # Returns size, sha256, ETag and Last-Modified, or None when validators (the ETag and Last-Modified we have) show the file is unchanged
+        if validators is not None:
+            headers = dict(headers or {})
+            if validators[0]:
+                headers["If-None-Match"] = validators[0]
+            if validators[1]:
+                headers["If-Modified-Since"] = validators[1]
+        if post_data is None:
+            resp = self.session.get(url, stream=True, timeout=self.timeout, headers=headers)
+        else:
+            resp = self.session.post(url, data=post_data, stream=True, timeout=self.timeout, headers=headers)
+        size = 0
+        sha = hashlib.sha256()
+        with resp:
+            resp.raise_for_status()
+            if resp.status_code == 304:
+                return None
+            # stream into a temp file next to the target and only rename it into place once complete, a killed run never leaves a partial file that later runs would skip
+            fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file)), prefix=os.path.basename(file) + ".", suffix=".part")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in resp.iter_content(chunk_size=64*1024):
+                        f.write(chunk)
+                        size += len(chunk)
+                        sha.update(chunk)
+                expected = resp.headers.get("Content-Length")
+                if expected is not None and resp.headers.get("Content-Encoding", "identity") == "identity" and int(expected) != size:
+                    raise TruncatedDownloadError(url, resp.status_code, f"truncated, got {size} of {expected} bytes")
+                if self.validate_content:
+                    problem = validateFileContent(temp_file, file)
+                    if problem is not None:
+                        raise DownloadError(url, resp.status_code, problem)
+                os.replace(temp_file, file)
+            except BaseException:
+                os.remove(temp_file)
+                raise
+        return size, sha.hexdigest(), resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+
+def validateFileContent(path, name=None):
+    # Cheap structural checks on what we store, returns why the file looks corrupt or None if it looks fine
+    name = name or path
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(2)
+        f.seek(max(size - 32, 0))
+        tail = f.read()
+    if name.endswith(".jpg"):
+        if head != b'\xff\xd8':
+            return "missing JPEG start of image marker"
+        if b'\xff\xd9' not in tail: #some encoders pad a few bytes after the end of image marker
+            return "missing JPEG end of image marker, likely truncated"
+    elif name.endswith(".dam"):
+        if size == 0 or head.startswith(b'<'):
+            return "empty or an html/xml error page rather than a DAM mesh"
+    return None
+
+def verifyArchive(root, manifest=None, log=logging):
+    # Removes files that look corrupt (and any left over partial downloads) so the download run that follows fetches them again
+    removed = 0
+    for dirpath, dirs, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            problem = None
+            if filename.endswith(".part"):
+                problem = "left over partial download"
+            elif filename.endswith(".jpg") or filename.endswith(".dam"):
+                problem = validateFileContent(path)
+                entry = manifest.lookup(path) if manifest is not None else None
+                if problem is None and entry is not None and entry[2] is not None and entry[2] != os.path.getsize(path):
+                    problem = f"size {os.path.getsize(path)} does not match the {entry[2]} bytes downloaded"
+            if problem is not None:
+                log.warning(f'Verify: removing {path} to be downloaded again as: {problem}')
+                os.remove(path)
+                if manifest is not None:
+                    manifest.forget(path)
+                removed += 1
+    if manifest is not None: #a file deleted by hand would otherwise never be downloaded again, the manifest says it is there
+        for key, entry in list(manifest.entries.items()):
+            path = os.path.join(manifest.root, key)
+            if entry[4] == 200 and not os.path.exists(path):
+                log.warning(f'Verify: {path} is in the manifest but missing, it will be downloaded again')
+                manifest.forget(path)
+                removed += 1
+    print(f"Verify: {removed} corrupt, partial or missing files will be downloaded again")
+    return removed
+
+class DownloadManifest:
+    # Every fetch for a page (local path, url, size, hash and http status) is recorded in the page directory so reruns can skip known complete and known missing files without touching the network or the disk
+    def __init__(self, path):
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, url TEXT, size INTEGER, sha256 TEXT, status INTEGER, fetched REAL, etag TEXT, last_modified TEXT)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        for column in ["etag", "last_modified"]: #manifests from before --refresh
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        self.entries = {row[0]: row for row in self.db.execute("SELECT path, url, size, sha256, status, fetched, etag, last_modified FROM files")}
+        self.unsaved = 0
+
+    def key(self, file):
+        return os.path.relpath(os.path.abspath(file), self.root).replace(os.path.sep, "/")
+
+    def lookup(self, file):
+        return self.entries.get(self.key(file))
+
+    def record(self, url, file, status, size=None, sha256=None, etag=None, last_modified=None):
+        row = (self.key(file), url.split("?")[0], size, sha256, status, time.time(), etag, last_modified) #access keys change every run so they are not kept
+        with self.lock:
+            self.entries[row[0]] = row
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)", row)
+            self.unsaved += 1
+            if self.unsaved >= 200:
+                self.db.commit()
+                self.unsaved = 0
+
+    def updateContent(self, file, size, sha256):
+        # the file was rewritten in place (an optimized tile), the url, status and validators still hold
+        key = self.key(file)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            self.entries[key] = entry[:2] + (size, sha256) + entry[4:]
+            self.db.execute("UPDATE files SET size=?, sha256=? WHERE path=?", (size, sha256, key))
+
+    def forget(self, file):
+        key = self.key(file)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.db.execute("DELETE FROM files WHERE path=?", (key,))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+class StaticAssetCache:
+    # Content addressed store of static.matterport.com files shared by every tour downloaded with it, tours get hardlinks to the single stored copy (or a copy if the cache is on another filesystem)
+    # Only used for assets that are never rewritten in place, a patched file like showcase.js would change the cached copy through the link
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        makeDirs(os.path.join(self.cache_dir, "objects"))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS assets (url TEXT PRIMARY KEY, sha256 TEXT)")
+        self.db.commit()
+        self.hits = 0
+
+    def objectPath(self, sha256):
+        return os.path.join(self.cache_dir, "objects", sha256[:2], sha256)
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT sha256 FROM assets WHERE url=?", (url.split("?")[0],)).fetchone()
+        if row is not None and os.path.exists(self.objectPath(row[0])):
+            return self.objectPath(row[0])
+        return None
+
+    def add(self, url, file):
+        sha = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha.update(chunk)
+        object_path = self.objectPath(sha.hexdigest())
+        with self.lock:
+            if os.path.exists(object_path): #same content under another url, keep one copy
+                linkOrCopy(object_path, file)
+            else:
+                makeDirs(os.path.dirname(object_path))
+                linkOrCopy(file, object_path)
+            self.db.execute("INSERT OR REPLACE INTO assets VALUES (?,?)", (url.split("?")[0], sha.hexdigest()))
+            self.db.commit()
+
+    def fetch(self, tour, url, file):
+        file = tour.path(file)
+        if os.path.exists(file) or tour.manifest.lookup(file) is not None:
+            return tour.downloadFile(url, file) #already in this tour (or known missing), let the usual skip logic handle it
+        cached = self.lookup(url)
+        if cached is not None:
+            makeDirs(os.path.dirname(file))
+            linkOrCopy(cached, file)
+            tour.manifest.record(url, file, 200, os.path.getsize(file))
+            with self.lock:
+                self.hits += 1
+            tour.log.debug(f'Linked {url} from the static asset cache to: {file}')
+            return "skipped"
+        result = tour.downloadFile(url, file)
+        self.add(url, file)
+        return result
+
+class Rewriter:
+    # Applies many literal (str) and regex (compiled pattern) substitutions in a single pass, rather than a chain of str.replace/re.sub calls that each copy the whole text.
+    # A replacement can be a list with one entry per output (None keeps the matched text) so one pass can write several differently patched copies of a file
+    MAX_MATCH = 4096 #no match is longer than this, so streaming only has to hold back this much text between chunks
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.regex = re.compile("|".join(f"(?P<r{i}>{pattern.pattern if isinstance(pattern, re.Pattern) else re.escape(pattern)})" for i, (pattern, replacement) in enumerate(rules)))
+        self.counts = [0] * len(rules)
+
+    def replacements(self, match, outputs):
+        rule = int(match.lastgroup[1:])
+        self.counts[rule] += 1
+        replacement = self.rules[rule][1]
+        per_output = replacement if isinstance(replacement, list) else [replacement] * outputs
+        return [match.group(0) if value is None else value for value in per_output]
+
+    def sub(self, text, output=0):
+        return self.regex.sub(lambda match: self.replacements(match, output + 1)[output], text)
+
+    def rewriteFile(self, source, targets, chunk_size=1024*1024):
+        # Streams source through the substitutions into each of targets (which may include source itself), holding at most about chunk_size characters
+        temp_targets = [f"{target}.rewrite.part" for target in targets]
+        outputs = [open(temp_target, "w", encoding="UTF-8", newline="") for temp_target in temp_targets]
+        try:
+            with open(source, "r", encoding="UTF-8", newline="") as f:
+                buffer = ""
+                done = False
+                while not done:
+                    chunk = f.read(chunk_size)
+                    done = chunk == ""
+                    buffer += chunk
+                    safe = len(buffer) if done else len(buffer) - self.MAX_MATCH #a match starting past here might continue in the next chunk
+                    position = 0
+                    for match in self.regex.finditer(buffer):
+                        if match.start() >= safe:
+                            break
+                        for out, replacement in zip(outputs, self.replacements(match, len(outputs))):
+                            out.write(buffer[position:match.start()])
+                            out.write(replacement)
+                        position = match.end()
+                    flush_to = max(position, safe)
+                    for out in outputs:
+                        out.write(buffer[position:flush_to])
+                    buffer = buffer[flush_to:]
+            for out in outputs:
+                out.close()
+            for temp_target, target in zip(temp_targets, targets):
+                os.replace(temp_target, target)
+        except BaseException:
+            for out, temp_target in zip(outputs, temp_targets):
+                out.close()
+                if os.path.exists(temp_target):
+                    os.remove(temp_target)
+            raise
+
+def linkOrCopy(source, target):
+    # replace target with a hardlink to source, falling back to a copy across filesystems
+    temp_target = f"{target}.link.part"
+    try:
+        os.link(source, temp_target)
+    except OSError:
+        shutil.copyfile(source, temp_target)
+    os.replace(temp_target, target)
+
+COMPRESSIBLE_SUFFIXES = (".js", ".css", ".json", ".html", ".svg", ".txt")
+# content encoding => sidecar suffix, in the order the server prefers them
+SIDECAR_ENCODINGS = {"br": ".br", "gzip": ".gz"} if brotli is not None else {"gzip": ".gz"}
+
+def compressFile(path):
+    # writes path.gz (and path.br) next to path unless they are already newer than it, a sidecar that wouldn't save anything is skipped
+    with open(path, "rb") as f:
+        data = f.read()
+    written = 0
+    for encoding, suffix in SIDECAR_ENCODINGS.items():
+        sidecar = path + suffix
+        if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+            continue
+        compressed = brotli.compress(data) if encoding == "br" else gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) >= len(data):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            continue
+        temp_path = sidecar + ".part"
+        with open(temp_path, "wb") as f:
+            f.write(compressed)
+        os.replace(temp_path, sidecar)
+        written += 1
+    return written
+
+def compressArchive(root, log=logging):
+    # compressing once here means the server never has to, the zlib/brotli calls release the GIL so a thread pool uses every core
+    paths = [os.path.join(dirpath, filename) for dirpath, dirs, filenames in os.walk(root) for filename in filenames if filename.endswith(COMPRESSIBLE_SUFFIXES)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+        written = sum(pool.map(compressFile, paths))
+    log.info(f'Wrote {written} compressed sidecars for {len(paths)} text files')
+    return written
+
+def packArchive(root, target, log=logging):
+    # One uncompressed zip holding the whole tour, copying or backing up one big file is far faster than tens of thousands of tiles.  Stored (not deflated) members
+    # can be served straight out of the file by the server and the zip central directory doubles as the path => offset index
+    temp_target = target + ".part"
+    count = 0
+    with zipfile.ZipFile(temp_target, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for dirpath, dirs, filenames in os.walk(root):
+            dirs.sort()
+            for filename in sorted(filenames):
+                if filename.endswith((".part", "-journal")) or filename == "server.log":
+                    continue
+                path = os.path.join(dirpath, filename)
+                zf.write(path, os.path.relpath(path, root).replace(os.sep, "/"))
+                count += 1
+    os.replace(temp_target, target)
+    log.info(f'Packed {count} files into {target}')
+    return count
+
+# image variant => media type, in the order the server prefers them
+TILE_VARIANT_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+JPEGTRAN = shutil.which("jpegtran")
+
+def availableTileVariants(variants):
+    # the requested variants Pillow was built to write, AVIF needs Pillow 11.2 or later
+    if Image is None:
+        return []
+    return [variant for variant in TILE_VARIANT_TYPES if variant in variants and variant in features.modules and features.check_module(variant)]
+
+def fileHash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def optimizeTile(path, optimize, need_hash, variants):
+    # Runs in a worker process.  Recompresses the JPEG with jpegtran -optimize, which only rebuilds the huffman tables so the pixels are unchanged, and writes path.webp/path.avif
+    # unless they are already newer than it, a variant that isn't smaller than the JPEG is skipped.  Returns the bytes saved, whether the file changed and its hash when asked for
+    saved = 0
+    changed = False
+    if optimize and JPEGTRAN is not None:
+        temp_path = path + ".opt.part"
+        result = subprocess.run([JPEGTRAN, "-copy", "none", "-optimize", "-outfile", temp_path, path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode == 0 and os.path.getsize(temp_path) < os.path.getsize(path) and validateFileContent(temp_path) is None:
+            saved = os.path.getsize(path) - os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+            changed = True
+        elif os.path.exists(temp_path):
+            os.remove(temp_path)
+    for variant in variants:
+        variant_path = f"{path}.{variant}"
+        if not os.path.exists(variant_path) or os.path.getmtime(variant_path) < os.path.getmtime(path):
+            temp_path = variant_path + ".part"
+            try:
+                with Image.open(path) as image:
+                    image.save(temp_path, format=variant.upper(), quality=90)
+            except OSError: #not a jpg Pillow can decode, the server just keeps sending it as is
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                continue
+            if os.path.getsize(temp_path) >= os.path.getsize(path):
+                os.remove(temp_path)
+                if os.path.exists(variant_path):
+                    os.remove(variant_path)
+                continue
+            os.replace(temp_path, variant_path)
+    return path, saved, changed, fileHash(path) if need_hash or changed else None
+
+def optimizeTiles(root, optimize=True, variants=(), manifest=None, log=logging):
+    # Post processing of the jpg tiles and textures under models/, spread over every core with a process pool as the work is CPU bound.  With optimize the files downloaded
+    # since the last optimize run (the marker's mtime) are recompressed, then byte identical files and their variants are hardlinked together, sweeps often share the same
+    # plain tiles (sky, floor, walls).  The hashes of files that haven't changed come from the manifest so a rerun doesn't read the whole archive
+    marker = os.path.join(root, TILES_OPTIMIZED_NAME)
+    since = os.path.getmtime(marker) if os.path.exists(marker) else 0
+    available = availableTileVariants(variants)
+    if len(available) < len(variants):
+        log.warning(f'Cannot write {", ".join(variant for variant in variants if variant not in available)} tile variants, Pillow is missing or built without them')
+    variants = available
+    paths = [os.path.join(dirpath, filename) for dirpath, dirs, filenames in os.walk(os.path.join(root, "models")) for filename in filenames if filename.endswith(".jpg")]
+    if optimize and JPEGTRAN is None:
+        log.info('jpegtran not found, tiles are kept as downloaded')
+    entries = [manifest.lookup(path) if manifest is not None else None for path in paths]
+    new = [optimize and os.path.getmtime(path) > since for path in paths]
+    need_hash = [optimize and (is_new or entry is None or entry[3] is None) for is_new, entry in zip(new, entries)]
+    saved = 0
+    by_hash = {}
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        for (path, path_saved, changed, sha), entry in zip(pool.map(optimizeTile, paths, new, need_hash, [variants] * len(paths), chunksize=32), entries):
+            saved += path_saved
+            if sha is not None and manifest is not None and entry is not None and (changed or entry[3] != sha):
+                manifest.updateContent(path, os.path.getsize(path), sha)
+            if optimize:
+                by_hash.setdefault(sha or entry[3], []).append(path)
+    linked = 0
+    for files in by_hash.values():
+        for duplicate in files[1:]:
+            # identical jpgs make identical variants, so those are linked along with them
+            for source, target in [(files[0], duplicate)] + [(f"{files[0]}.{variant}", f"{duplicate}.{variant}") for variant in TILE_VARIANT_TYPES]:
+                if not os.path.exists(source) or not os.path.exists(target) or os.path.samefile(source, target):
+                    continue
+                temp_path = target + ".link.part"
+                try:
+                    os.link(source, temp_path)
+                except OSError: #filesystem without hardlinks, keep the copies
+                    continue
+                saved += os.path.getsize(target)
+                os.replace(temp_path, target)
+                linked += 1
+    if optimize:
+        with open(marker, "w"):
+            pass
+    log.info(f'Processed {len(paths)} tiles with {", ".join(variants) or "no"} variants{"" if optimize else ", not optimized"}, saved {saved} bytes, {linked} duplicates hardlinked')
+    return saved
+
+ACCESS_KEY_RE = re.compile(r't=2\-.+?\-0')
+# kinds of cdn url that can need different keys, by a marker in the path, anything else goes by its extension
+ACCESS_KEY_URL_CLASSES = [("tiles", "/tiles/"), ("textures", "_texture_"), ("images", "/images/")]
+
+class AccessKeyManager:
+    # The cdn only serves model files with a valid access key (the t=2-...-0 query parameter) and keys expire during long runs.  Every url is signed here with the current key,
+    # keys are fetched again before they are expected to expire and when one expires anyway the first thread to notice refreshes them once while the others wait instead of each
+    # walking every key.  The key that worked for each kind of url is remembered so a file that really is missing or forbidden costs one request, not one per key
+    def __init__(self, fetch_keys, lifetime=1200, min_age=30, log=logging):
+        self.fetch_keys = fetch_keys #returns the keys in order of preference
+        self.lifetime = lifetime
+        self.min_age = min_age #keys younger than this are taken to be valid, a 403 then means that file is forbidden
+        self.log = log
+        self.cond = threading.Condition()
+        self.keys = []
+        self.fetched = 0
+        self.generation = 0
+        self.refreshing = False
+        self.stale = False
+        self.working = {} #url class => key that downloaded one of them
+
+    def urlClass(self, url):
+        path = urlparse(url).path
+        for url_class, marker in ACCESS_KEY_URL_CLASSES:
+            if marker in path:
+                return url_class
+        return os.path.splitext(path)[1] or "other"
+
+    def refresh(self, expired_generation=None):
+        # Only one thread fetches.  A scheduled refresh lets everyone carry on with the old keys meanwhile, after an expiry (expired_generation, the keys the failed url
+        # was signed with) sign() holds every download until the new keys are in, unless they were already replaced since.  Returns whether there are newer keys to try
+        with self.cond:
+            if expired_generation is not None:
+                if expired_generation != self.generation:
+                    return True
+                if not self.refreshing and time.time() - self.fetched < self.min_age:
+                    return False
+            if self.refreshing:
+                if expired_generation is None:
+                    return False
+                self.stale = True
+                while self.refreshing:
+                    self.cond.wait()
+                return self.generation != expired_generation
+            self.refreshing = True
+            self.stale = expired_generation is not None
+        keys = None
+        try:
+            keys = self.fetch_keys()
+        except Exception as ex:
+            self.log.warning(f'Refreshing the access keys failed, keeping the current ones: {str(ex)}')
+        with self.cond:
+            if keys:
+                if keys != self.keys:
+                    self.working = {}
+                self.keys = keys
+                self.generation += 1
+            self.fetched = time.time()
+            self.refreshing = False
+            self.stale = False
+            self.cond.notify_all()
+        if keys:
+            self.log.info(f'Access keys refreshed{" after one expired" if expired_generation is not None else ""}, {len(keys)} keys')
+        return bool(keys)
+
+    def sign(self, url):
+        # the url with the key that works for its kind of url and the generation of the keys used, None for urls without a key
+        match = ACCESS_KEY_RE.search(url)
+        if match is None:
+            return url, None
+        if time.time() - self.fetched > self.lifetime:
+            self.refresh()
+        with self.cond:
+            while self.stale:
+                self.cond.wait()
+            key = self.working.get(self.urlClass(url)) or (self.keys[0] if self.keys else match.group(0))
+            return url.replace(match.group(0), key), self.generation
+
+    def worked(self, url):
+        match = ACCESS_KEY_RE.search(url)
+        url_class = self.urlClass(url)
+        if match is not None and self.working.get(url_class) != match.group(0):
+            with self.cond:
+                if match.group(0) in self.keys:
+                    self.working[url_class] = match.group(0)
+
+    def alternatives(self, url, status_code):
+        # the url signed with each of the other keys, none once a key is known to work for this kind of url as the file just isn't there (or is forbidden)
+        match = ACCESS_KEY_RE.search(url)
+        with self.cond:
+            if match is None or self.urlClass(url) in self.working:
+                return []
+            return [url.replace(match.group(0), key) for key in self.keys if key != match.group(0)]
+
+class TourDownloader:
+    # Archives one tour into output_root/pageid.  Everything a run needs (paths, access keys, graph requests, manifest) lives on the object rather than in module globals or the working directory,
+    # so many tours can be downloaded at once from threads of one process sharing a Transport, scheduler and StaticAssetCache
+    def __init__(self, pageid, output_root=".", transport=None, scheduler=None, static_cache=None, graph_requests=None, advanced_download=False, max_tile_resolution=None, verify=False, show_progress=True, compress=True, pack=False, log_level="INFO", exporter=None, refresh=False, optimize_tiles=False, tile_variants=(), key_lifetime=1200):
+        self.pageid = getPageId(pageid)
+        self.page_root = os.path.abspath(os.path.join(output_root, self.pageid))
+        self.transport = transport or getTransport()
+        self.scheduler = scheduler or getScheduler()
+        self.static_cache = static_cache
+        self.graph_requests = graph_requests if graph_requests is not None else readGraphReqs(GRAPH_POSTS_DIR, self.pageid)
+        self.advanced_download = advanced_download
+        self.max_tile_resolution = max_tile_resolution
+        self.verify = verify
+        self.show_progress = show_progress
+        self.compress = compress
+        self.pack = pack
+        self.log_level = log_level
+        self.exporter = exporter
+        self.refresh = refresh
+        self.optimize_tiles = optimize_tiles
+        self.tile_variants = tile_variants
+        self.refresh_lock = threading.Lock()
+        self.refresh_report = {}
+        self.refresh_changes = {}
+        self.metrics = None #a fresh RunMetrics for every download()
+        self.manifest = None
+        self.log = logging.getLogger(f"matterport-dl.{self.pageid}")
+        self.access_keys = AccessKeyManager(self.fetchAccessKeys, key_lifetime, log=self.log)
+        self.outstanding = 0
+        self.outstanding_cond = threading.Condition()
+        self.background = []
+
+    def path(self, relative):
+        return os.path.join(self.page_root, relative)
+
+    def status(self, message):
+        print(message if self.show_progress else f"[{self.pageid}] {message}")
+
+    def phase(self, name, detail=None):
+        self.metrics.startPhase(name)
+        self.status(f"{name}..." + (f" {detail}" if detail else ""))
+
+    def submit(self, fn, *args, host=None):
+        with self.outstanding_cond:
+            self.outstanding += 1
+        future = self.scheduler.submit(fn, *args, host=host)
+        future.add_done_callback(self._workDone)
+        return future
+
+    def _workDone(self, future):
+        with self.outstanding_cond:
+            self.outstanding -= 1
+            if self.outstanding == 0:
+                self.outstanding_cond.notify_all()
+
+    def scheduleDownload(self, url, file):
+        return self.submit(self.downloadFile, url, file, host=urlparse(url).hostname)
+
+    def phaseDone(self):
+        # with the threads engine each phase waits for its own files before the next starts, the async engine lets them overlap
+        if self.scheduler.phase_barriers:
+            self.waitForWork()
+
+    def waitForWork(self):
+        with self.outstanding_cond:
+            while self.outstanding > 0:
+                self.outstanding_cond.wait()
+
+    def runSerial(self, fn, *args):
+        # long serial sections (texture probing) run inline for the threads engine, otherwise on their own thread so they overlap with everything else.  Either way a failure is logged and the run carries on
+        def run():
+            try:
+                fn(*args)
+            except Exception as ex:
+                self.log.warning(f'Exception in {fn.__name__}: {str(ex)}')
+        if self.scheduler.phase_barriers:
+            run()
+            return
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.background.append(thread)
+
+    def fetchAccessKeys(self):
+        # the key the web client uses (files?type=3) first, then the others it and files?type=2 hand out, these also make sure they are fresh
+        keys = []
+        for file_type in [3, 2]:
+            resp = self.transport.request("GET", f"https://my.matterport.com/api/player/models/{self.pageid}/files?type={file_type}", log=self.log, metrics=self.metrics)
+            for key in ACCESS_KEY_RE.findall(resp.text):
+                if key not in keys:
+                    keys.append(key)
+        return keys
+
+    def recordDownload(self, url, file, size_and_hash):
+        self.manifest.record(url, file, 200, *size_and_hash)
+
+    def downloadFile(self, url, file, post_data=None):
+        url, key_generation = self.access_keys.sign(url)
+        file = self.path(file)
+
+        if "?" in file:
+            file = file.split('?')[0]
+        makeDirs(os.path.dirname(file))
+
+        entry = self.manifest.lookup(file)
+        validators = None
+        refetch = False
+        if entry is not None and entry[4] == 200 and self.refresh and not os.path.exists(file):
+            entry = None #deleted since, a conditional request could come back 304 and leave it missing
+        if entry is not None and entry[4] == 200:
+            if self.refresh and (entry[6] or entry[7]):
+                validators = (entry[6], entry[7]) #ask the server whether it changed
+            elif self.refresh and not self.manifest.key(file).startswith("models/"):
+                refetch = True #the api json rarely comes with validators but is small, so just fetch it again.  Model files without validators are from before --refresh existed and kept as they are
+            else:
+                self.log.debug(f'Skipping url: {url} as already downloaded according to the manifest')
+                self.metrics.recordSkip()
+                return "skipped"
+        if entry is not None and entry[4] == 404 and not self.refresh: #a refresh asks again, textures or sweeps may have been added since
+            self.log.debug(f'Skipping url: {url} as the manifest has it as not found')
+            self.metrics.recordSkip()
+            raise DownloadError(url, 404)
+
+        if os.path.exists(file) and validators is None and not refetch: #skip already downloaded files except idnex.html which is really json possibly wit hnewer access keys?
+            self.log.debug(f'Skipping url: {url} as already downloaded')
+            self.manifest.record(url, file, 200, os.path.getsize(file)) #downloaded before we kept a manifest
+            self.metrics.recordSkip()
+            return "skipped"
+        previous_hash = entry[3] if entry is not None else None
+        if entry is not None and entry[4] == 200 and previous_hash is None and os.path.exists(file): #recorded without a hash (it was there before the manifest), hash it before it is replaced
+            previous_hash = fileHash(file)
+        try:
+            result = self.transport.fetchToFile(url, file, post_data, self.log, self.metrics, validators=validators)
+            if result is None:
+                self.log.debug(f'Unchanged since the last run: {url}')
+                self.refreshed("unchanged")
+                return "skipped"
+            if entry is not None and entry[4] == 200:
+                if result[1] == previous_hash:
+                    self.refreshed("unchanged")
+                else:
+                    self.refreshed("changed", file)
+            elif self.refresh and file != self.path("js/showcase.js"): #showcase.js is fetched again and patched on every run, like the base page
+                self.refreshed("new", file)
+            self.recordDownload(url, file, result)
+            if key_generation is not None:
+                self.access_keys.worked(url)
+            self.log.debug(f'Successfully downloaded: {url} to: {file}')
+            return "ok"
+        except requests.exceptions.HTTPError as err:
+            self.log.warning(f'URL error dling {url} of will try alt: {str(err)}')
+            status_code = err.response.status_code
+
+            # Try again with the refreshed key if this one expired, then the other keys
+            if key_generation is not None:
+                retry_urls = []
+                if status_code in (401, 403) and self.access_keys.refresh(key_generation): #a 403 with keys that were just fetched is a plain failure
+                    url2 = self.access_keys.sign(url)[0]
+                    if url2 != url:
+                        retry_urls.append(url2)
+                retry_urls += [url2 for url2 in self.access_keys.alternatives(url, status_code) if url2 not in retry_urls]
+                for url2 in retry_urls:
+                    try:
+                        self.recordDownload(url2, file, self.transport.fetchToFile(url2, file, log=self.log, metrics=self.metrics))
+                        self.access_keys.worked(url2)
+                        self.log.debug(f'Successfully downloaded through alt: {url2} to: {file}')
+                        return "ok"
+                    except requests.exceptions.HTTPError as err:
+                        self.log.warning(f'URL error alt method tried url {url2} dling of: {str(err)}')
+                        if err.response.status_code != 404: #a 404 on every key means the file really isn't there
+                            status_code = err.response.status_code
+            self.log.error(f'Failed to succeed for url {url}')
+            if status_code == 404:
+                self.manifest.record(url, file, 404)
+            raise DownloadError(url, status_code)
+
+    def refreshed(self, outcome, name=None):
+        # --refresh bookkeeping: counts of unchanged/changed/new files plus the names of what changed for the report at the end
+        with self.refresh_lock:
+            self.refresh_report[outcome] = self.refresh_report.get(outcome, 0) + 1
+            if name is not None and len(self.refresh_changes.setdefault(outcome, [])) < 1000:
+                self.refresh_changes[outcome].append(os.path.relpath(name, self.page_root) if os.path.isabs(name) else name)
+
+    def tryDownload(self, url, file):
+        # Only a 404 means the file isn't there.  Any other failure is probed once more and then counted as present, treating it as missing would silently drop
+        # every later texture from the count, this way the search goes on and the file itself shows up as a failed download
+        for attempt in range(2):
+            try:
+                self.downloadFile(url, file)
+                return True
+            except Exception as ex:
+                if isinstance(ex, DownloadError) and ex.status_code == 404:
+                    self.log.debug(f'Probe of {url} not found: {str(ex)}')
+                    return False
+                self.log.warning(f'Probe of {url} failed (attempt {attempt + 1}): {str(ex)}')
+        self.log.error(f'Probe of {url} kept failing, counting it as present so the textures after it are still found')
+        return True
+
+    def downloadFileWithJSONPost(self, url, file, post_json_str, descriptor):
+        file = self.path(file)
+        makeDirs(os.path.dirname(file))
+        if os.path.exists(file): #skip already downloaded files except idnex.html which is really json possibly wit hnewer access keys?
+            self.log.debug(f'Skipping json post to url: {url} ({descriptor}) as already downloaded')
+
+        old_sha = None
+        if self.refresh and os.path.exists(file):
+            with open(file, "rb") as f:
+                old_sha = hashlib.sha256(f.read()).hexdigest()
+        body_bytes = bytes(post_json_str, "utf-8")
+        size, sha, etag, last_modified = self.transport.fetchToFile(url, file, body_bytes, self.log, self.metrics, headers={'Content-Type':'application/json'}) #streamed to disk like every other download
+        if old_sha is not None and old_sha != sha:
+            self.refreshed("graph_changed", descriptor)
+        self.log.debug(f'Successfully downloaded w/ JSON post to: {url} ({descriptor}) to: {file}')
+
+    def downloadUUID(self, accessurl, uuid, model_dir):
+        dam_file = os.path.join(model_dir, f'{uuid}_50k.dam')
+        self.downloadFile(accessurl.format(filename=f'{uuid}_50k.dam'), dam_file)
+        shutil.copy(self.path(dam_file), self.path(os.path.join(os.path.dirname(model_dir), f'{uuid}_50k.dam')))
+        def texture(quality, i):
+            filename = f'{uuid}_50k_texture_jpg_{quality}/{uuid}_50k_{i:03d}.jpg'
+            return accessurl.format(filename=filename), os.path.join(model_dir, filename)
+
+        count = findTextureCount(lambda i: self.tryDownload(*texture("high", i)))
+        self.log.info(f'Found {count} textures for {uuid}')
+        for i in range(count): #the probed ones are skipped as already downloaded
+            self.scheduleDownload(*texture("high", i))
+            self.scheduleDownload(*texture("low", i))
+
+    def downloadSweeps(self, accessurl, model_dir, sweep_plan):
+        results = {"ok":0, "skipped":0, "404":0, "failed":0}
+        failed = []
+        lock = threading.Lock()
+        futures = []
+        with tqdm(total=sum(len(variants) for variants in sweep_plan.values()), disable=not self.show_progress) as pbar:
+            def tileDone(tile, future):
+                result = downloadResult(future)
+                with lock:
+                    results[result] += 1
+                    if result == "failed":
+                        failed.append(tile)
+                pbar.update(1) #progress follows completed tiles, not queued ones
+
+            for sweep, variants in sweep_plan.items():
+                for variant in variants:
+                    tile = f'tiles/{sweep}/{variant}'
+                    future = self.scheduleDownload(accessurl.format(filename=tile) + "&imageopt=1", os.path.join(model_dir, tile)) #blocks while the scheduler queue is full
+                    future.add_done_callback(functools.partial(tileDone, tile))
+                    futures.append(future)
+            concurrent.futures.wait(futures)
+        summary = f'Sweep tiles: {results["ok"]} downloaded, {results["skipped"]} already present, {results["404"]} not found, {results["failed"]} failed'
+        self.status(summary)
+        self.log.info(summary)
+        for tile in failed:
+            self.log.error(f'Failed to download sweep tile: {tile}')
+        return results
+
+    def downloadGraphModels(self):
+        makeDirs(self.path("api/mp/models"))
+
+        for key in self.graph_requests:
+            file_path = f"api/mp/models/graph_{key}.json"
+            self.submit(self.downloadFileWithJSONPost, "https://my.matterport.com/api/mp/models/graph",file_path, self.graph_requests[key], key, host="my.matterport.com")
+        self.phaseDone()
+
+    def downloadAssets(self, base):
+        js_files = ["browser-check",
+            "30","46","47","66","79","134","136","143","164","250","251","316","321","356","371","376","383","386","422","423",
+            "464","524","525","539","580","584","606","614","666","670","718","721","726","755","764","828","833","838","932","947"]
+        language_codes = ["af", "sq", "ar-SA", "ar-IQ", "ar-EG", "ar-LY", "ar-DZ", "ar-MA", "ar-TN", "ar-OM",
+         "ar-YE", "ar-SY", "ar-JO", "ar-LB", "ar-KW", "ar-AE", "ar-BH", "ar-QA", "eu", "bg",
+         "be", "ca", "zh-TW", "zh-CN", "zh-HK", "zh-SG", "hr", "cs", "da", "nl", "nl-BE", "en",
+         "en-US", "en-EG", "en-AU", "en-GB", "en-CA", "en-NZ", "en-IE", "en-ZA", "en-JM",
+         "en-BZ", "en-TT", "et", "fo", "fa", "fi", "fr", "fr-BE", "fr-CA", "fr-CH", "fr-LU",
+         "gd", "gd-IE", "de", "de-CH", "de-AT", "de-LU", "de-LI", "el", "he", "hi", "hu",
+         "is", "id", "it", "it-CH", "ja", "ko", "lv", "lt", "mk", "mt", "no", "pl",
+         "pt-BR", "pt", "rm", "ro", "ro-MO", "ru", "ru-MI", "sz", "sr", "sk", "sl", "sb",
+         "es", "es-AR", "es-GT", "es-CR", "es-PA", "es-DO", "es-MX", "es-VE", "es-CO",
+         "es-PE", "es-EC", "es-CL", "es-UY", "es-PY", "es-BO", "es-SV", "es-HN", "es-NI",
+         "es-PR", "sx", "sv", "sv-FI", "th", "ts", "tn", "tr", "uk", "ur", "ve", "vi", "xh",
+         "ji", "zu"]
+        font_files = ["ibm-plex-sans-100", "ibm-plex-sans-100italic", "ibm-plex-sans-200", "ibm-plex-sans-200italic", "ibm-plex-sans-300",
+        "ibm-plex-sans-300italic", "ibm-plex-sans-500", "ibm-plex-sans-500italic", "ibm-plex-sans-600", "ibm-plex-sans-600italic",
+        "ibm-plex-sans-700", "ibm-plex-sans-700italic", "ibm-plex-sans-italic", "ibm-plex-sans-regular", "mp-font", "roboto-100", "roboto-100italic",
+        "roboto-300", "roboto-300italic", "roboto-500", "roboto-500italic", "roboto-700", "roboto-700italic", "roboto-900", "roboto-900italic",
+        "roboto-italic", "roboto-regular"]
+
+        #extension assumed to be .png unless it is .svg or .jpg, for anything else place it in assets
+        image_files = ["360_placement_pin_maskH", "chrome", "Desktop-help-play-button.svg", "Desktop-help-spacebar", "edge", "escape", "exterior",
+        "exterior_hover", "firefox", "headset-cardboard", "headset-quest", "interior", "interior_hover", "matterport-logo-light.svg",
+        "mattertag-disc-128-free.v1", "mobile-help-play-button.svg", "nav_help_360", "nav_help_click_inside", "nav_help_gesture_drag",
+        "nav_help_gesture_drag_two_finger", "nav_help_gesture_pinch", "nav_help_gesture_position", "nav_help_gesture_position_two_finger",
+        "nav_help_gesture_tap", "nav_help_inside_key", "nav_help_keyboard_all", "nav_help_keyboard_left_right", "nav_help_keyboard_up_down",
+        "nav_help_mouse_click", "nav_help_mouse_drag_left", "nav_help_mouse_drag_right", "nav_help_mouse_position_left",
+        "nav_help_mouse_position_right", "nav_help_mouse_zoom", "nav_help_tap_inside", "nav_help_zoom_keys", "NoteColor", "NoteIcon", "pinAnchor",
+        "puck_256_red", "roboto-700-42_0", "safari", "scope.svg", "showcase-password-background.jpg", "surface_grid_planar_256", "tagbg", "tagmask",
+        "vert_arrows"]
+
+        assets = ["css/showcase.css", "css/unsupported_browser.css", "cursors/grab.png", "cursors/grabbing.png", "cursors/zoom-in.png",
+        "cursors/zoom-out.png", "locale/strings.json", "css/ws-blur.css"]
+
+        self.downloadFile(base + "js/showcase.js","js/showcase.js")
+        with open(self.path("js/showcase.js"), "r", encoding="UTF-8") as f:
+            showcase_cont = f.read()
+        #lets try to extract the js files it might be loading and make sure we know them
+        js_extracted = re.findall(r'\.e\(([0-9]{2,3})\)', showcase_cont)
+        js_extracted.sort()
+        for js in js_extracted:
+            if js not in js_files:
+                print(f'JS FILE EXTRACTED BUT not known, please file a github issue and tell us to add: {js}.js, will download for you though:)')
+                js_files.append(js)
+
+
+        for image in image_files:
+            if not image.endswith(".jpg") and not image.endswith(".svg"):
+                image = image + ".png"
+            assets.append("images/" + image)
+        for js in js_files:
+            assets.append("js/" + js + ".js")
+        for f in font_files:
+            assets.extend(["fonts/" + f + ".woff", "fonts/" + f + ".woff2"])
+        for lc in language_codes:
+            assets.append("locale/messages/strings_" + lc + ".json")
         for asset in assets:
             local_file = asset
             if local_file.endswith('/'):
                 local_file = local_file    + "index.html"
-            executor.submit(downloadFile, f"{base}{asset}", local_file)
-
-def setAccessURLs(pageid):
-    global accessurls
-    with open(f"api/player/models/{pageid}/files_type2", "r", encoding="UTF-8") as f:
-        filejson = json.load(f)
-        accessurls.append(filejson["base.url"].split("?")[-1])
-    with open(f"api/player/models/{pageid}/files_type3", "r", encoding="UTF-8") as f:
-        filejson = json.load(f)
-        accessurls.append(filejson["templates"][0].split("?")[-1])
-
-def downloadInfo(pageid):
-    assets = [f"api/v1/jsonstore/model/highlights/{pageid}", f"api/v1/jsonstore/model/Labels/{pageid}", f"api/v1/jsonstore/model/mattertags/{pageid}", f"api/v1/jsonstore/model/measurements/{pageid}", f"api/v1/player/models/{pageid}/thumb?width=1707&dpr=1.5&disable=upscale", f"api/v1/player/models/{pageid}/", f"api/v2/models/{pageid}/sweeps", "api/v2/users/current", f"api/player/models/{pageid}/files"]
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            if self.static_cache is not None:
+                self.submit(self.static_cache.fetch, self, f"{base}{asset}", local_file, host=urlparse(base).hostname)
+            else:
+                self.scheduleDownload(f"{base}{asset}", local_file)
+        self.phaseDone()
+
+    def downloadInfo(self):
+        pageid = self.pageid
+        assets = [f"api/v1/jsonstore/model/highlights/{pageid}", f"api/v1/jsonstore/model/Labels/{pageid}", f"api/v1/jsonstore/model/mattertags/{pageid}", f"api/v1/jsonstore/model/measurements/{pageid}", f"api/v1/player/models/{pageid}/thumb?width=1707&dpr=1.5&disable=upscale", f"api/v2/models/{pageid}/sweeps", "api/v2/users/current", f"api/player/models/{pageid}/files"]
+        # the model json is needed by the pics and model phases so we wait on it even when the other info files are queued behind other phases
+        old_sweeps = None
+        if self.refresh and os.path.exists(self.path(f"api/v1/player/models/{pageid}/index.html")):
+            old_sweeps = self.readModelData().get("sweeps") or []
+        self.downloadFile(f"https://my.matterport.com/api/v1/player/models/{pageid}/", f"api/v1/player/models/{pageid}/index.html")
+        if old_sweeps is not None:
+            new_sweeps = self.readModelData().get("sweeps") or []
+            # tiles of new sweeps aren't in the manifest so they are downloaded as usual, removed sweeps are kept in the archive
+            self.refresh_changes["sweeps_added"] = sorted(set(new_sweeps) - set(old_sweeps))
+            self.refresh_changes["sweeps_removed"] = sorted(set(old_sweeps) - set(new_sweeps))
         for asset in assets:
             local_file = asset
             if local_file.endswith('/'):
                 local_file = local_file    + "index.html"
-            executor.submit(downloadFile, f"https://my.matterport.com/{asset}", local_file    )
-    makeDirs("api/mp/models")
-    with open(f"api/mp/models/graph", "w", encoding="UTF-8") as f:
-        f.write('{"data": "empty"}')
-    for i in range(1,4):
-        downloadFile(f"https://my.matterport.com/api/player/models/{pageid}/files?type={i}", f"api/player/models/{pageid}/files_type{i}")
-    setAccessURLs(pageid)
-
-def downloadPics(pageid):
-    with open(f"api/v1/player/models/{pageid}/index.html", "r", encoding="UTF-8") as f:
-        modeldata = json.load(f)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            self.scheduleDownload(f"https://my.matterport.com/{asset}", local_file)
+        self.phaseDone()
+        makeDirs(self.path("api/mp/models"))
+        with open(self.path("api/mp/models/graph"), "w", encoding="UTF-8") as f:
+            f.write('{"data": "empty"}')
+        for i in range(1,4):
+            self.downloadFile(f"https://my.matterport.com/api/player/models/{pageid}/files?type={i}", f"api/player/models/{pageid}/files_type{i}")
+
+    def readModelData(self):
+        with open(self.path(f"api/v1/player/models/{self.pageid}/index.html"), "r", encoding="UTF-8") as f:
+            return json.load(f)
+
+    def downloadPics(self):
+        modeldata = self.readModelData()
         for image in modeldata["images"]:
-            executor.submit(downloadFile, image["src"], urlparse(image["src"]).path[1:])
-
-def downloadModel(pageid,accessurl):
-    global ADVANCED_DOWNLOAD_ALL
-    with open(f"api/v1/player/models/{pageid}/index.html", "r", encoding="UTF-8") as f:
-        modeldata = json.load(f)
-    accessid = re.search(r'models/([a-z0-9-_./~]*)/\{filename\}', accessurl).group(1)
-    makeDirs(f"models/{accessid}")
-    os.chdir(f"models/{accessid}")
-    downloadUUID(accessurl,modeldata["job"]["uuid"])
-    downloadSweeps(accessurl, modeldata["sweeps"])
-
-
-# Patch showcase.js to fix expiration issue
-def patchShowcase():
-    global SHOWCASE_INTERNAL_NAME
-    with open("js/showcase.js","r",encoding="UTF-8") as f:
-        j = f.read()
-    j = re.sub(r"\&\&\(!e.expires\|\|.{1,10}\*e.expires>Date.now\(\)\)","",j)
-    j = j.replace(f'"/api/mp/','`${window.location.pathname}`+"api/mp/')
-    j = j.replace("${this.baseUrl}", "${window.location.origin}${window.location.pathname}")
-    j = j.replace('e.get("https://static.matterport.com/geoip/",{responseType:"json",priority:n.RequestPriority.LOW})', '{"country_code":"US","country_name":"united states","region":"CA","city":"los angeles"}')
-    with open(f"js/{SHOWCASE_INTERNAL_NAME}","w",encoding="UTF-8") as f:
-        f.write(j)
-    j = j.replace(f'"POST"','"GET"') #no post requests for external hosted
-    with open("js/showcase.js","w",encoding="UTF-8") as f:
-        f.write(j)
+            self.scheduleDownload(image["src"], urlparse(image["src"]).path[1:])
+        self.phaseDone()
 
-def drange(x, y, jump):
-  while x < y:
-    yield float(x)
-    x += decimal.Decimal(jump)
+    def downloadModel(self, accessurl, preload_json):
+        modeldata = self.readModelData()
+        accessid = re.search(r'models/([a-z0-9-_./~]*)/\{filename\}', accessurl).group(1)
+        model_dir = f"models/{accessid}"
+        makeDirs(self.path(model_dir))
+        self.runSerial(self.downloadUUID, accessurl, modeldata["job"]["uuid"], model_dir)
+        self.downloadSweeps(accessurl, model_dir, planSweepTiles(preload_json, modeldata["sweeps"], self.max_tile_resolution, self.log))
 
-KNOWN_ACCESS_KEY=None
-def GetOrReplaceKey(url, is_read_key):
-    global KNOWN_ACCESS_KEY
-    key_regex = r'(t=2\-.+?\-0)'
-    match = re.search(key_regex,url)
-    if match is None:
-        return url
-    url_key = match.group(1)
-    if KNOWN_ACCESS_KEY is None and is_read_key:
-        KNOWN_ACCESS_KEY = url_key
-    elif not is_read_key and KNOWN_ACCESS_KEY:
-        url = url.replace(url_key, KNOWN_ACCESS_KEY)
-    return url
-
-
-def downloadPage(pageid):
-    global ADVANCED_DOWNLOAD_ALL
-    makeDirs(pageid)
-    os.chdir(pageid)
-
-    ADV_CROP_FETCH = [
-            {
-                "start":"width=512&crop=1024,1024,",
-                "increment":'0.5'
-            },
-            {
-                "start":"crop=512,512,",
-               "increment":'0.25'
-            }
-        ]
+    # Patch showcase.js to fix expiration issue
+    def patchShowcase(self):
+        # one streaming pass writes both the internal copy our server uses and showcase.js for other web servers, which also has no post requests
+        showcase_rewriter = Rewriter([(re.compile(r"\&\&\(!e.expires\|\|.{1,10}\*e.expires>Date.now\(\)\)"), ""),
+            ('"/api/mp/', '`${window.location.pathname}`+"api/mp/'),
+            ("${this.baseUrl}", "${window.location.origin}${window.location.pathname}"),
+            ('e.get("https://static.matterport.com/geoip/",{responseType:"json",priority:n.RequestPriority.LOW})', '{"country_code":"US","country_name":"united states","region":"CA","city":"los angeles"}'),
+            ('"POST"', [None, '"GET"'])])
+        showcase_rewriter.rewriteFile(self.path("js/showcase.js"), [self.path(f"js/{SHOWCASE_INTERNAL_NAME}"), self.path("js/showcase.js")])
+        self.log.debug(f'Patched showcase.js, replacement counts: {showcase_rewriter.counts}')
 
-    try:
-        logging.basicConfig(filename='run_report.log', encoding='utf-8', level=logging.DEBUG,  format='%(asctime)s %(levelname)-8s %(message)s',datefmt='%Y-%m-%d %H:%M:%S')
-    except ValueError:
-        logging.basicConfig(filename='run_report.log', level=logging.DEBUG,  format='%(asctime)s %(levelname)-8s %(message)s',datefmt='%Y-%m-%d %H:%M:%S')
-    logging.debug(f'Started up a download run')
-    page_root_dir = os.path.abspath('.')
-    print("Downloading base page...")
-    r = requests.get(f"https://my.matterport.com/show/?m={pageid}")
-    r.encoding = "utf-8"
-    staticbase = re.search(r'<base href="(https://static.matterport.com/.*?)">', r.text).group(1)
-    match = re.search(r'"(https://cdn-\d*\.matterport\.com/models/[a-z0-9\-_/.]*/)([{}0-9a-z_/<>.]+)(\?t=.*?)"', r.text)
-    if match:
-        accessurl = f'{match.group(1)}~/{{filename}}{match.group(3)}'
-        print(accessurl)
-    else:
-        raise Exception("Can't find urls")
+    def downloadAdvancedTextures(self, preload_json):
+        ADV_CROP_FETCH = [
+                {
+                    "start":"width=512&crop=1024,1024,",
+                    "increment":'0.5'
+                },
+                {
+                    "start":"crop=512,512,",
+                   "increment":'0.25'
+                }
+            ]
+        #download dam files
+        base_node = preload_json["queries"]["GetModelPrefetch"]["data"]["model"]["assets"]
+        for mesh in base_node["meshes"]:
+            try:
+                self.downloadFile(mesh["url"], urlparse(mesh["url"]).path[1:])#not expecting the non 50k one to work but mgiht as well try
+            except:
+                pass
+        crop_adds = []
+        for crop in ADV_CROP_FETCH:
+            for x in list(drange(0, 1, decimal.Decimal(crop["increment"]))):
+                for y in list(drange(0, 1, decimal.Decimal(crop["increment"]))):
+                    xs = f'{x}'
+                    ys = f'{y}'
+                    if xs.endswith('.0'):
+                        xs = xs[:-2]
+                    if ys.endswith('.0'):
+                        ys = ys[:-2]
+                    crop_adds.append(f'{crop["start"]}x{xs},y{ys}')
+        for texture in base_node["textures"]:
+            try:
+                def textureUrl(i):
+                    return texture["urlTemplate"].replace("<texture>",f'{i:03d}')
+                def textureFile(i):
+                    return urlparse(textureUrl(i)).path[1:]
+                count = findTextureCount(lambda i: self.tryDownload(textureUrl(i), textureFile(i)))
+                self.log.info(f'Found {count} {texture["quality"]} quality textures')
+                for i in range(count):
+                    self.scheduleDownload(textureUrl(i), textureFile(i))
+                    if texture["quality"] == "high":
+                        for complete_add in crop_adds:
+                            self.scheduleDownload(textureUrl(i) + "&" + complete_add, textureFile(i) + complete_add.replace("&","_") + ".jpg")
+            except Exception as ex:
+                self.log.warning(f'Advanced download of the {texture.get("quality")} quality textures failed: {str(ex)}')
 
+    def download(self):
+        makeDirs(self.page_root)
+        handler = logging.FileHandler(self.path('run_report.log'), encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+        # download threads only put records on a queue, one listener thread does the formatting and file writes
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        self.log.addHandler(queue_handler)
+        self.log.setLevel(self.log_level)
+        self.metrics = RunMetrics(self.pageid)
+        if self.exporter is not None:
+            self.exporter.add(self.metrics)
+        sampling = threading.Event()
+        def sampleConcurrency():
+            while not sampling.wait(1):
+                self.metrics.sampleConcurrency(self.transport.limiter)
+        threading.Thread(target=sampleConcurrency, daemon=True).start()
+        self.manifest = DownloadManifest(self.path(MANIFEST_NAME))
+        try:
+            self._download()
+        finally:
+            sampling.set()
+            self.metrics.finish()
+            summary = self.metrics.summary()
+            with open(self.path("run_metrics.json"), "w", encoding="UTF-8") as f:
+                json.dump(summary, f, indent=1)
+            self.log.info(f'Run took {summary["seconds"]}s, {summary["requests"]} requests ({summary["statuses"]}), {summary["bytes"]} bytes, {summary["retries"]} retries, {summary["skipped"]} skipped: ' + ", ".join(f'{phase["name"]} {phase["seconds"]}s' for phase in summary["phases"]))
+            self.manifest.close()
+            self.log.removeHandler(queue_handler)
+            listener.stop()
+            handler.close()
+        if self.pack: #only once the manifest is committed and closed and the metrics and log are written, so the zip has their final contents
+            self.status(f"Packing into {self.page_root}.zip...")
+            count = packArchive(self.page_root, self.page_root + ".zip", self.log)
+            self.status(f"Packed {count} files into {self.page_root}.zip") #run_report.log is already closed
+        self.status("Done!")
 
-    file_type_content = requests.get(f"https://my.matterport.com/api/player/models/{pageid}/files?type=3") #get a valid access key, there are a few but this is a common client used one, this also makes sure it is fresh
-    GetOrReplaceKey(file_type_content.text,True)
-    if ADVANCED_DOWNLOAD_ALL:
-        print("Doing advanced download of dollhouse/floorplan data...")
-        ## Started to parse the modeldata further.  As it is error prone tried to try catch silently for failures. There is more data here we could use for example:
-        ## queries.GetModelPrefetch.data.model.locations[X].pano.skyboxes[Y].tileUrlTemplate
-        ## queries.GetModelPrefetch.data.model.locations[X].pano.skyboxes[Y].urlTemplate
-        ## queries.GetModelPrefetch.data.model.locations[X].pano.resolutions[Y] <--- has the resolutions they offer for this one
-        ## goal here is to move away from some of the access url hacks, but if we are successful on try one won't matter:)
+    def _download(self):
+        pageid = self.pageid
+        self.log.debug(f'Started up a download run')
+        if self.verify:
+            self.phase("Verifying existing files")
+            verifyArchive(self.page_root, self.manifest, self.log)
+        self.phase("Downloading base page")
+        r = self.transport.request("GET", f"https://my.matterport.com/show/?m={pageid}", log=self.log, metrics=self.metrics)
+        r.encoding = "utf-8"
+        staticbase = re.search(r'<base href="(https://static.matterport.com/.*?)">', r.text).group(1)
+        match = re.search(r'"(https://cdn-\d*\.matterport\.com/models/[a-z0-9\-_/.]*/)([{}0-9a-z_/<>.]+)(\?t=.*?)"', r.text)
+        if match:
+            accessurl = f'{match.group(1)}~/{{filename}}{match.group(3)}'
+            self.status(accessurl)
+        else:
+            raise Exception("Can't find urls")
 
 
-        try:
-            match = re.search(r'window.MP_PREFETCHED_MODELDATA = (\{.+?\}\}\});', r.text)
-            if match:
+        self.access_keys.refresh() #get valid access keys, the urls in the page are signed with them from here on
+        preload_json = None
+        match = re.search(r'window.MP_PREFETCHED_MODELDATA = (\{.+?\}\}\});', r.text)
+        if match:
+            try:
                 preload_json = json.loads(match.group(1))
-                #download dam files
-                base_node = preload_json["queries"]["GetModelPrefetch"]["data"]["model"]["assets"]
-                for mesh in base_node["meshes"]:
-                    try:
-                        downloadFile(mesh["url"], urlparse(mesh["url"]).path[1:])#not expecting the non 50k one to work but mgiht as well try
-                    except:
-                        pass
-                for texture in base_node["textures"]:
-                    try: #on first exception assume we have all the ones needed
-                        for i in range(1000):
-                            full_text_url = texture["urlTemplate"].replace("<texture>",f'{i:03d}')
-                            crop_to_do = []
-                            if texture["quality"] == "high":
-                                crop_to_do = ADV_CROP_FETCH
-                            for crop in crop_to_do:
-                                for x in list(drange(0, 1, decimal.Decimal(crop["increment"]))):
-                                    for y in list(drange(0, 1, decimal.Decimal(crop["increment"]))):
-                                        xs = f'{x}'
-                                        ys = f'{y}'
-                                        if xs.endswith('.0'):
-                                            xs = xs[:-2]
-                                        if ys.endswith('.0'):
-                                            ys = ys[:-2]
-                                        complete_add=f'{crop["start"]}x{xs},y{ys}'
-                                        complete_add_file = complete_add.replace("&","_")
-                                        try:
-                                            downloadFile(full_text_url + "&" + complete_add, urlparse(full_text_url).path[1:] + complete_add_file + ".jpg")
-                                        except:
-                                            pass
-
-                            downloadFile(full_text_url, urlparse(full_text_url).path[1:])
-                    except:
-                        pass
-        except:
-            pass
-    # Automatic redirect if GET param isn't correct
-    injectedjs = 'if (window.location.search != "?m=' + pageid + '") { document.location.search = "?m=' + pageid + '"; }'
-    content = r.text.replace(staticbase,".").replace('"https://cdn-1.matterport.com/','`${window.location.origin}${window.location.pathname}` + "').replace('"https://mp-app-prod.global.ssl.fastly.net/','`${window.location.origin}${window.location.pathname}` + "').replace("window.MP_PREFETCHED_MODELDATA",f"{injectedjs};window.MP_PREFETCHED_MODELDATA").replace('"https://events.matterport.com/', '`${window.location.origin}${window.location.pathname}` + "')
-    content = re.sub(r"validUntil\":\s*\"20[\d]{2}-[\d]{2}-[\d]{2}T","validUntil\":\"2099-01-01T",content)
-    with open("index.html", "w", encoding="UTF-8") as f:
-        f.write(content )
-
-    print("Downloading static assets...")
-    if os.path.exists("js/showcase.js"): #we want to always fetch showcase.js in case we patch it differently or the patching function starts to not work well run multiple times on itself
-        os.replace("js/showcase.js","js/showcase-bk.js") #backing up existing showcase file to be safe
-    downloadAssets(staticbase)
-    # Patch showcase.js to fix expiration issue and some other changes for local hosting
-    patchShowcase()
-    print("Downloading model info...")
-    downloadInfo(pageid)
-    print("Downloading images...")
-    downloadPics(pageid)
-    print("Downloading graph model data...")
-    downloadGraphModels(pageid)
-    print(f"Downloading model... access url: {accessurl}")
-    downloadModel(pageid,accessurl)
-    os.chdir(page_root_dir)
-    open("api/v1/event", 'a').close()
-    print("Done!")
+            except ValueError as err:
+                self.log.warning(f'Unable to parse MP_PREFETCHED_MODELDATA, will fall back to fetching every tile resolution: {str(err)}')
+        if self.advanced_download and preload_json is not None:
+            self.phase("Doing advanced download of dollhouse/floorplan data")
+            ## Started to parse the modeldata further.  As it is error prone tried to try catch silently for failures. There is more data here we could use for example:
+            ## queries.GetModelPrefetch.data.model.locations[X].pano.skyboxes[Y].tileUrlTemplate
+            ## queries.GetModelPrefetch.data.model.locations[X].pano.skyboxes[Y].urlTemplate
+            ## queries.GetModelPrefetch.data.model.locations[X].pano.resolutions[Y] <--- has the resolutions they offer for this one
+            ## goal here is to move away from some of the access url hacks, but if we are successful on try one won't matter:)
+
+
+            self.runSerial(self.downloadAdvancedTextures, preload_json)
+        # Automatic redirect if GET param isn't correct
+        injectedjs = 'if (window.location.search != "?m=' + pageid + '") { document.location.search = "?m=' + pageid + '"; }'
+        local_origin = '`${window.location.origin}${window.location.pathname}` + "'
+        page_rewriter = Rewriter([(staticbase, "."), ('"https://cdn-1.matterport.com/', local_origin), ('"https://mp-app-prod.global.ssl.fastly.net/', local_origin),
+            ("window.MP_PREFETCHED_MODELDATA", f"{injectedjs};window.MP_PREFETCHED_MODELDATA"), ('"https://events.matterport.com/', local_origin),
+            (re.compile(r"validUntil\":\s*\"20[\d]{2}-[\d]{2}-[\d]{2}T"), "validUntil\":\"2099-01-01T")])
+        with open(self.path("index.html"), "w", encoding="UTF-8") as f:
+            f.write(page_rewriter.sub(r.text))
+
+        self.phase("Downloading static assets")
+        if os.path.exists(self.path("js/showcase.js")): #we want to always fetch showcase.js in case we patch it differently or the patching function starts to not work well run multiple times on itself
+            os.replace(self.path("js/showcase.js"),self.path("js/showcase-bk.js")) #backing up existing showcase file to be safe
+        self.manifest.forget(self.path("js/showcase.js"))
+        self.downloadAssets(staticbase)
+        # Patch showcase.js to fix expiration issue and some other changes for local hosting
+        self.patchShowcase()
+        self.phase("Downloading model info")
+        self.downloadInfo()
+        self.phase("Downloading images")
+        self.downloadPics()
+        self.phase("Downloading graph model data")
+        self.downloadGraphModels()
+        self.phase("Downloading model", f"access url: {accessurl}")
+        self.downloadModel(accessurl,preload_json)
+        for thread in self.background:
+            thread.join()
+        self.waitForWork()
+        open(self.path("api/v1/event"), 'a').close()
+        if self.refresh:
+            report = dict(self.refresh_report, sweeps_added=len(self.refresh_changes.get("sweeps_added", [])), sweeps_removed=len(self.refresh_changes.get("sweeps_removed", [])))
+            self.metrics.refresh = dict(report, changes=self.refresh_changes)
+            self.status(f"Refresh: {report.get('changed', 0)} files changed, {report.get('new', 0)} new, {report.get('unchanged', 0)} unchanged, {report.get('graph_changed', 0)} graph responses changed, {report['sweeps_added']} sweeps added, {report['sweeps_removed']} removed")
+            for outcome, names in self.refresh_changes.items():
+                for name in names:
+                    self.log.info(f'Refresh {outcome}: {name}')
+        if self.optimize_tiles or self.tile_variants:
+            self.phase("Optimizing tiles")
+            optimizeTiles(self.page_root, self.optimize_tiles, self.tile_variants, self.manifest, self.log)
+        if self.compress:
+            self.phase("Compressing text assets")
+            compressArchive(self.page_root, self.log)
+
+def tourOptions():
+    # TourDownloader settings from the command line
+    return dict(static_cache=STATIC_CACHE, advanced_download=ADVANCED_DOWNLOAD_ALL, max_tile_resolution=MAX_TILE_RESOLUTION, verify=VERIFY_ARCHIVE, compress=COMPRESS_ASSETS, pack=PACK_ARCHIVE, log_level=LOG_LEVEL, exporter=METRICS_EXPORTER, refresh=REFRESH_ARCHIVE, optimize_tiles=OPTIMIZE_TILES, tile_variants=TILE_VARIANTS, key_lifetime=ACCESS_KEY_LIFETIME)
+
+def downloadPage(pageid, output_root="."):
+    TourDownloader(pageid, output_root, **tourOptions()).download()
 
 def initiateDownload(url):
     downloadPage(getPageId(url))
+
+def readBatchFile(path):
+    # one url or page id per line, blank lines and # comments ignored, - reads from stdin
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r", encoding="UTF-8") as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+def initiateBatchDownload(urls, parallel_tours=4, output_root="."):
+    # Up to parallel_tours tours are archived at once, all sharing the scheduler (so the concurrency limits apply across tours), connection pool and static asset cache
+    transport = getTransport()
+    scheduler = getScheduler()
+    failed = []
+    finished = 0
+    def downloadOne(url):
+        TourDownloader(url, output_root, transport, scheduler, show_progress=parallel_tours == 1, **tourOptions()).download()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_tours) as tours:
+        futures = {tours.submit(downloadOne, url): getPageId(url) for url in urls}
+        for future in concurrent.futures.as_completed(futures):
+            pageid = futures[future]
+            if future.exception() is not None:
+                logging.error(f'Batch download of {pageid} failed: {str(future.exception())}')
+                print(f"Failed to download {pageid}: {str(future.exception())}")
+                failed.append(pageid)
+            else:
+                finished += 1
+                print(f"Finished {pageid} ({finished}/{len(urls)})")
+    print(f"Batch done, {len(urls) - len(failed)} of {len(urls)} tours downloaded" + (f", failed: {', '.join(failed)}" if failed else ""))
+    return failed
+
 def getPageId(url):
     return url.split("m=")[-1].split("&")[0]
 
+CROP_FILE_RE = re.compile(r'^(.*\.jpg)(?:width=([^_/]*)_)?crop=([^/]*)\.jpg$')
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+class PackedFile:
+    # one member of a PackedArchive, a zero copy view into the mapped zip
+    def __init__(self, view, mtime):
+        self.view = view
+        self.mtime = mtime
+
+    def close(self):
+        pass
+
+class PackedArchive:
+    # Serves a zip written by packArchive without unpacking it: the members are stored uncompressed so each one is just an offset and length into the mmap'd file
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                if info.compress_type != zipfile.ZIP_STORED:
+                    logging.warning(f'Packed archive member {info.filename} is compressed and cannot be served, repack with --pack')
+                    continue
+                # the data starts after the local header, whose extra field can differ from the central directory's
+                header = ZIP_LOCAL_HEADER.unpack_from(self.mmap, info.header_offset)
+                offset = info.header_offset + ZIP_LOCAL_HEADER.size + header[9] + header[10]
+                self.entries["/" + info.filename] = (offset, info.file_size, time.mktime(info.date_time + (0, 0, -1)))
+
+    def open(self, url_path):
+        offset, length, mtime = self.entries[url_path]
+        return PackedFile(memoryview(self.mmap)[offset:offset + length], mtime)
+
+    def read(self, url_path):
+        offset, length, mtime = self.entries[url_path]
+        return self.mmap[offset:offset + length]
+
+class ArchiveIndex:
+    # Everything the handler's rewrites need, read once at startup (or on reload) so routing a request is a dict lookup instead of stat calls and file reads
+    def __init__(self, root, graph_names, pack=None):
+        self.root = root
+        self.pack = pack
+        self.files = set()
+        self.crops = {}
+        self.sidecars = {}
+        self.variants = {}
+        if pack is not None:
+            all_files = pack.entries.keys()
+        else:
+            all_files = []
+            for dirpath, dirnames, filenames in os.walk(root):
+                rel_dir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+                for name in filenames:
+                    all_files.append("/" + name if rel_dir == "." else f"/{rel_dir}/{name}")
+        for url_path in all_files:
+            self.files.add(url_path)
+            crop_match = CROP_FILE_RE.match(url_path)
+            if crop_match:
+                self.crops[crop_match.groups()] = url_path
+        for url_path in self.files:
+            if url_path.endswith(COMPRESSIBLE_SUFFIXES):
+                source_mtime = self.mtime(url_path)
+                # a sidecar older than its file is from before the file was downloaded again, serving it would be stale
+                encodings = [encoding for encoding, suffix in SIDECAR_ENCODINGS.items() if url_path + suffix in self.files and self.mtime(url_path + suffix) >= source_mtime]
+                if encodings:
+                    self.sidecars[url_path] = encodings
+            elif url_path.endswith(".jpg"):
+                variants = [variant for variant in TILE_VARIANT_TYPES if f"{url_path}.{variant}" in self.files and self.mtime(f"{url_path}.{variant}") >= self.mtime(url_path)]
+                if variants:
+                    self.variants[url_path] = variants
+        self.showcase_internal = f"/js/{SHOWCASE_INTERNAL_NAME}" in self.files
+        self.graph = {}
+        for option_name in graph_names:
+            url_path = f"/api/mp/models/graph_{option_name}.json"
+            if url_path in self.files:
+                self.graph[option_name] = {encoding: self.read(url_path + SIDECAR_ENCODINGS.get(encoding, "")) for encoding in ["identity"] + self.sidecars.get(url_path, [])}
+
+    def mtime(self, url_path):
+        if self.pack is not None:
+            return self.pack.entries[url_path][2]
+        return os.path.getmtime(os.path.join(self.root, url_path[1:]))
+
+    def read(self, url_path):
+        if self.pack is not None:
+            return self.pack.read(url_path)
+        with open(os.path.join(self.root, url_path[1:]), "rb") as f:
+            return f.read()
+
+def acceptedValues(header):
+    # the content codings an Accept-Encoding header (or media types an Accept header) allows, q=0 means not acceptable
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = re.search(r'q=([0-9.]+)', params)
+        if coding and not (q and float(q.group(1)) == 0):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+class ReplayServer(socketserver.ThreadingMixIn, HTTPServer):
+    # a thread per connection so one slow client or a burst of tile requests doesn't queue everyone else
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, root=".", graph_names=(), pack_path=None):
+        self.root = root
+        self.graph_names = list(graph_names)
+        self.pack_path = pack_path
+        self.reload()
+        HTTPServer.__init__(self, server_address, handler_class)
+
+    def reload(self):
+        # build the new index fully before swapping it in, handler threads only ever see a complete one.  A replaced pack is mapped again, the old mapping is freed once no request is using it
+        index = ArchiveIndex(self.root, self.graph_names, PackedArchive(self.pack_path) if self.pack_path else None)
+        self.index = index
+        logging.info(f"Indexed {len(index.files)} files, {len(index.crops)} crop variants and {len(index.graph)} graph responses")
+
 class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #keep-alive, the browser fetches hundreds of tiles over a handful of connections
+
     def send_error(self, code, message=None):
         if code == 404:
             logging.warning(f'404 error: {self.path} may not be downloading everything right')
         SimpleHTTPRequestHandler.send_error(self, code, message)
 
     def do_GET(self):
-        global SHOWCASE_INTERNAL_NAME
+        index = self.server.index
         redirect_msg=None
         orig_request = self.path
-        if self.path.startswith("/js/showcase.js") and os.path.exists(f"js/{SHOWCASE_INTERNAL_NAME}"):
+        if self.path.startswith("/js/showcase.js") and index.showcase_internal:
             redirect_msg = "using our internal showcase.js file"
             self.path = f"/js/{SHOWCASE_INTERNAL_NAME}"
 
-        if self.path.startswith("/locale/messages/strings_") and not os.path.exists(f".{self.path}"):
+        if self.path.startswith("/locale/messages/strings_") and urllib.parse.unquote(self.path.partition('?')[0]) not in index.files:
             redirect_msg = "original request was for a locale we do not have downloaded"
             self.path = "/locale/strings.json"
         raw_path, _, query = self.path.partition('?')
         if "crop=" in query and raw_path.endswith(".jpg"):
             query_args = urllib.parse.parse_qs(query)
-            crop_addition = query_args.get("crop", None)
-            if crop_addition is not None:
-                crop_addition = f'crop={crop_addition[0]}'
-            else:
-                crop_addition = ''
-
-            width_addition = query_args.get("width", None)
-            if width_addition is not None:
-                width_addition = f'width={width_addition[0]}_'
-            else:
-                width_addition = ''
-            test_path = raw_path + width_addition + crop_addition + ".jpg"
-            if os.path.exists(f".{test_path}"):
-                self.path = test_path
+            crop = query_args.get("crop", [None])[0]
+            width = query_args.get("width", [None])[0]
+            test_path = index.crops.get((urllib.parse.unquote(raw_path), width, crop))
+            if test_path is not None:
+                self.path = urllib.parse.quote(test_path)
                 redirect_msg = "dollhouse/floorplan texture request that we have downloaded, better than generic texture file"
         if redirect_msg is not None or orig_request != self.path:
             logging.info(f'Redirecting {orig_request} => {self.path} as {redirect_msg}')
@@ -431,27 +1671,148 @@ class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
 
         SimpleHTTPRequestHandler.do_GET(self)
         return;
+    def send_head(self):
+        # Same as SimpleHTTPRequestHandler for directories, files additionally get validators, caching headers and single range support (the .dam files are large)
+        self.range = None
+        index = self.server.index
+        raw_path = self.path.split('?')[0]
+        url_path = urllib.parse.unquote(raw_path)
+        if url_path.endswith("/") and url_path + "index.html" in index.files:
+            url_path += "index.html"
+        path = self.translate_path(url_path)
+        if url_path not in index.files: #directories, 404s and anything added since the index was built
+            if index.pack is not None:
+                self.send_error(404, "File not found")
+                return None
+            if os.path.isdir(path) or not os.path.isfile(path):
+                return SimpleHTTPRequestHandler.send_head(self)
+        content_type = self.guess_type(path)
+        content_encoding = None
+        variant = None
+        vary = None
+        if url_path.endswith(COMPRESSIBLE_SUFFIXES):
+            vary = "Accept-Encoding"
+            accepted = acceptedValues(self.headers.get("Accept-Encoding"))
+            content_encoding = next((encoding for encoding in index.sidecars.get(url_path, []) if encoding in accepted), None)
+            if content_encoding is not None:
+                url_path += SIDECAR_ENCODINGS[content_encoding]
+                path += SIDECAR_ENCODINGS[content_encoding]
+        elif url_path in index.variants:
+            # only browsers that name the type get it, a */* fetch keeps the jpg
+            vary = "Accept"
+            accepted = acceptedValues(self.headers.get("Accept"))
+            variant = next((variant for variant in index.variants[url_path] if TILE_VARIANT_TYPES[variant] in accepted), None)
+            if variant is not None:
+                url_path += f".{variant}"
+                path += f".{variant}"
+                content_type = TILE_VARIANT_TYPES[variant]
+        if index.pack is not None:
+            f = index.pack.open(url_path)
+            size, mtime_ns = len(f.view), int(f.mtime * 1e9)
+        else:
+            f = open(path, 'rb')
+            fs = os.fstat(f.fileno())
+            size, mtime_ns = fs.st_size, fs.st_mtime_ns
+        try:
+            etag = f'"{size:x}-{mtime_ns:x}' + (f'-{content_encoding or variant}"' if content_encoding or variant else '"')
+            last_modified = self.date_time_string(mtime_ns // 1000000000)
+            # nothing is immutable, --refresh, --optimize-tiles and --tile-variants replace tiles and textures in place, so browsers keep everything but revalidate it with the ETag
+            cache_control = "no-cache"
+
+            if self.headers.get("If-None-Match") == etag or (self.headers.get("If-None-Match") is None and self.headers.get("If-Modified-Since") == last_modified):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", cache_control)
+                if vary is not None:
+                    self.send_header("Vary", vary)
+                self.end_headers()
+                f.close()
+                return None
+
+            start, length = 0, size
+            range_match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get("Range", "").strip())
+            if range_match and (range_match.group(1) or range_match.group(2)) and self.headers.get("If-Range", etag) == etag:
+                if range_match.group(1):
+                    start = int(range_match.group(1))
+                    end = min(int(range_match.group(2)), size - 1) if range_match.group(2) else size - 1
+                else: #suffix range, the last n bytes
+                    start = max(0, size - int(range_match.group(2)))
+                    end = size - 1
+                if start >= size or end < start:
+                    f.close()
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return None
+                length = end - start + 1
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.range = (start, length)
+            self.send_header("Content-Type", content_type)
+            if content_encoding is not None:
+                self.send_header("Content-Encoding", content_encoding)
+            if vary is not None:
+                self.send_header("Vary", vary)
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            return f
+        except:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile):
+        if self.range is None:
+            return SimpleHTTPRequestHandler.copyfile(self, source, outputfile)
+        start, length = self.range
+        if length == 0:
+            return
+        if isinstance(source, PackedFile):
+            outputfile.write(source.view[start:start + length])
+            return
+        outputfile.flush()
+        self.connection.sendfile(source, start, length) #zero copy where the OS supports it
+
+    def sendBody(self, body, content_type="application/json", content_encoding=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if content_encoding is not None:
+            self.send_header("Content-Encoding", content_encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self):
         post_msg=None
+        post_body=b""
+        try:
+            # the body is read whatever the path, on a keep-alive connection anything left unread would be parsed as the next request
+            post_body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        except (ValueError, OSError):
+            self.close_connection = True
         try:
             if self.path == "/api/mp/models/graph":
-                self.send_response(200)
-                self.end_headers()
-                content_len = int(self.headers.get('content-length'))
-                post_body = self.rfile.read(content_len).decode('utf-8')
-                json_body = json.loads(post_body)
+                json_body = json.loads(post_body.decode('utf-8'))
                 option_name = json_body["operationName"]
                 if option_name in GRAPH_DATA_REQ:
-                    file_path = f"api/mp/models/graph_{option_name}.json"
-                    if os.path.exists(file_path):
-                        with open(file_path, "r", encoding="UTF-8") as f:
-                            self.wfile.write(f.read().encode('utf-8'))
-                            post_msg=f"graph of operationName: {option_name} we are handling internally"
-                            return;
+                    graph_response = self.server.index.graph.get(option_name)
+                    if graph_response is not None:
+                        accepted = acceptedValues(self.headers.get("Accept-Encoding"))
+                        content_encoding = next((encoding for encoding in SIDECAR_ENCODINGS if encoding in graph_response and encoding in accepted), "identity")
+                        self.sendBody(graph_response[content_encoding], content_encoding=None if content_encoding == "identity" else content_encoding)
+                        post_msg=f"graph of operationName: {option_name} we are handling internally"
+                        return;
                     else:
                         post_msg=f"graph for operationName: {option_name} we don't know how to handle, but likely could add support, returning empty instead"
 
-                self.wfile.write(bytes('{"data": "empty"}', "utf-8"))
+                self.sendBody(bytes('{"data": "empty"}', "utf-8"))
                 return
         except Exception as error:
             post_msg = f"Error trying to handle a post request of: {str(error)} this should not happen"
@@ -468,25 +1829,151 @@ class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
             return "text/html; charset=UTF-8"
         return res
 
+# Defaults for the command line, TourDownloader/Transport take these as arguments when used as a library
 PROXY=False
 ADVANCED_DOWNLOAD_ALL=False
+HTTP_POOL_SIZE=32
+RETRY_POLICY=RetryPolicy()
+THREAD_WORKERS=32
+DOWNLOAD_ENGINE="threads"
+DOWNLOAD_ENGINES = ["threads", "async"]
+MAX_IN_FLIGHT=64
+PER_HOST_LIMIT=16
+MAX_TILE_RESOLUTION=None
+VALIDATE_CONTENT=True
+STATIC_CACHE=None
+VERIFY_ARCHIVE=False
+BATCH_TOURS=4
+COMPRESS_ASSETS=True
+PACK_ARCHIVE=False
+LOG_LEVEL="INFO"
+REFRESH_ARCHIVE=False
+OPTIMIZE_TILES=False
+TILE_VARIANTS=[]
+ACCESS_KEY_LIFETIME=1200
+METRICS_EXPORTER=None
 
 GRAPH_DATA_REQ = {}
 
-def openDirReadGraphReqs(path,pageId):
+def readGraphReqs(path,pageId):
+    graph_requests = {}
     for root, dirs, filenames in os.walk(path):
         for file in filenames:
             with open(os.path.join(root, file), "r", encoding="UTF-8") as f:
-                GRAPH_DATA_REQ[file.replace(".json","")] = f.read().replace("[MATTERPORT_MODEL_ID]",pageId)
+                graph_requests[file.replace(".json","")] = f.read().replace("[MATTERPORT_MODEL_ID]",pageId)
+    return graph_requests
 
-def getUrlOpener(use_proxy):
-    if (use_proxy):
-        proxy = urllib.request.ProxyHandler({'http': use_proxy,'https': use_proxy})
-        opener = urllib.request.build_opener(proxy)
-    else:
-        opener = urllib.request.build_opener()
-    opener.addheaders = [('User-Agent','Mozilla/5.0 (Windows NT 10.0; Win64; x64)'),('x-matterport-application-name','showcase')]
-    return opener
+def buildSession(use_proxy, pool_size):
+    session = requests.Session()
+    # pool_block makes threads wait for a free keep-alive connection instead of opening throwaway ones past the pool size
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if use_proxy:
+        session.proxies = {'http': use_proxy, 'https': use_proxy}
+    session.headers.update({'User-Agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64)', 'x-matterport-application-name':'showcase'})
+    return session
+
+class ThreadedScheduler:
+    # The original engine, a fixed set of worker threads fed by a bounded queue where each phase waits for all of its files before the next phase starts
+    phase_barriers = True
+
+    def __init__(self, max_workers=32, max_queued=64):
+        self.queue = queue.Queue(maxsize=max_queued)
+        for _ in range(max_workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        while True:
+            future, fn, args = self.queue.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as ex:
+                        future.set_exception(ex)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args, host=None):
+        future = concurrent.futures.Future()
+        self.queue.put((future, fn, args)) #blocks the producer while the queue is full rather than queueing unbounded work
+        return future
+
+    def join(self):
+        self.queue.join()
+
+class AsyncScheduler:
+    # All phases enqueue into one asyncio loop so work overlaps instead of waiting on phase barriers, limited by a global in flight budget and a per host budget
+    phase_barriers = False
+
+    def __init__(self, max_in_flight=64, per_host=16, max_pending=1024):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self.pending_slots = threading.BoundedSemaphore(max_pending)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.per_host = per_host
+        self.host_limits = {}
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._setup(max_in_flight), self.loop).result()
+
+    async def _setup(self, max_in_flight):
+        # semaphores are created on the loop thread so they bind to our loop on older pythons
+        self.global_limit = asyncio.Semaphore(max_in_flight)
+
+    async def _run(self, host, fn, args):
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        # the host budget first, a task waiting on a busy host must not hold a global slot that work for other hosts could use
+        async with self.host_limits[host]:
+            async with self.global_limit:
+                return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    def _track(self, future):
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._untrack)
+        return future
+
+    def _untrack(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.pending_slots.release()
+
+    def submit(self, fn, *args, host=None):
+        self.pending_slots.acquire() #blocks the producer rather than queueing unbounded work
+        return self._track(asyncio.run_coroutine_threadsafe(self._run(host, fn, args), self.loop))
+
+    def join(self):
+        while True:
+            with self.lock:
+                waiting = list(self.pending)
+            if not waiting:
+                return
+            concurrent.futures.wait(waiting)
+
+SCHEDULER = None
+def getScheduler():
+    global SCHEDULER
+    with SHARED_LOCK:
+        if SCHEDULER is None:
+            if DOWNLOAD_ENGINE == "async":
+                SCHEDULER = AsyncScheduler(MAX_IN_FLIGHT, PER_HOST_LIMIT)
+            else:
+                SCHEDULER = ThreadedScheduler(THREAD_WORKERS)
+        return SCHEDULER
+
+TRANSPORT = None
+def getTransport():
+    # the shared transport for the command line settings
+    global TRANSPORT
+    with SHARED_LOCK:
+        if TRANSPORT is None:
+            TRANSPORT = Transport(PROXY, HTTP_POOL_SIZE, MAX_IN_FLIGHT if DOWNLOAD_ENGINE == "async" else THREAD_WORKERS, RETRY_POLICY, validate_content=VALIDATE_CONTENT)
+        return TRANSPORT
+
+SHARED_LOCK = threading.Lock()
 
 def getCommandLineArg(name, has_value):
     for i in range(1,len(sys.argv)):
@@ -501,23 +1988,79 @@ def getCommandLineArg(name, has_value):
 if __name__ == "__main__":
     ADVANCED_DOWNLOAD_ALL = getCommandLineArg("--advanced-download", False)
     PROXY = getCommandLineArg("--proxy", True)
-    OUR_OPENER = getUrlOpener(PROXY)
-    urllib.request.install_opener(OUR_OPENER)
+    HTTP_POOL_SIZE = int(getCommandLineArg("--pool-size", True) or HTTP_POOL_SIZE)
+    DOWNLOAD_ENGINE = getCommandLineArg("--engine", True) or DOWNLOAD_ENGINE
+    MAX_IN_FLIGHT = int(getCommandLineArg("--max-in-flight", True) or MAX_IN_FLIGHT)
+    PER_HOST_LIMIT = int(getCommandLineArg("--per-host", True) or PER_HOST_LIMIT)
+    MAX_TILE_RESOLUTION = getCommandLineArg("--max-tile-resolution", True) or None
+    RETRY_POLICY = RetryPolicy(attempts=int(getCommandLineArg("--retries", True) or 4) + 1)
+    VALIDATE_CONTENT = not getCommandLineArg("--no-validate", False)
+    VERIFY_ARCHIVE = getCommandLineArg("--verify", False)
+    COMPRESS_ASSETS = not getCommandLineArg("--no-compress", False)
+    PACK_ARCHIVE = getCommandLineArg("--pack", False)
+    REFRESH_ARCHIVE = getCommandLineArg("--refresh", False)
+    OPTIMIZE_TILES = getCommandLineArg("--optimize-tiles", False)
+    ACCESS_KEY_LIFETIME = int(getCommandLineArg("--key-lifetime", True) or ACCESS_KEY_LIFETIME)
+    tile_variants = getCommandLineArg("--tile-variants", True)
+    TILE_VARIANTS = [variant.strip().lower() for variant in tile_variants.split(",")] if tile_variants else TILE_VARIANTS
+    LOG_LEVEL = (getCommandLineArg("--log-level", True) or LOG_LEVEL).upper()
+    metrics_port = getCommandLineArg("--metrics-port", True)
+    metrics_file = getCommandLineArg("--metrics-file", True)
+    metrics_interval = float(getCommandLineArg("--metrics-interval", True) or 10)
+    if metrics_port or metrics_file:
+        metrics_address, _, metrics_port = (metrics_port or "").rpartition(":") #--metrics-port 0.0.0.0:9100 to listen on other interfaces
+        METRICS_EXPORTER = MetricsExporter(metrics_port, metrics_file, metrics_interval, metrics_address or "127.0.0.1")
+    batch_file = getCommandLineArg("--batch", True)
+    static_cache_dir = getCommandLineArg("--static-cache", True)
+    if batch_file and not static_cache_dir:
+        static_cache_dir = "static_cache"
+    if static_cache_dir:
+        STATIC_CACHE = StaticAssetCache(static_cache_dir)
+    if MAX_TILE_RESOLUTION is not None and MAX_TILE_RESOLUTION not in TILE_RESOLUTIONS:
+        print(f"--max-tile-resolution must be one of: {', '.join(TILE_RESOLUTIONS)}")
+        sys.exit(1)
+    if DOWNLOAD_ENGINE not in DOWNLOAD_ENGINES:
+        print(f"--engine must be one of: {', '.join(DOWNLOAD_ENGINES)}")
+        sys.exit(1)
+    BATCH_TOURS = int(getCommandLineArg("--parallel-tours", True) or BATCH_TOURS)
     pageId = ""
     if len(sys.argv) > 1:
         pageId = getPageId(sys.argv[1])
-    openDirReadGraphReqs("graph_posts",pageId)
-    if len(sys.argv) == 2:
+    if batch_file or len(sys.argv) == 2:
+        logging.getLogger().addHandler(logging.NullHandler()) #each tour logs to its own run_report.log
+    if batch_file:
+        failed = initiateBatchDownload(readBatchFile(batch_file), BATCH_TOURS)
+        if METRICS_EXPORTER is not None and metrics_file:
+            METRICS_EXPORTER.writeSnapshot() #the final numbers, not the last periodic ones
+        sys.exit(1 if failed else 0)
+    elif len(sys.argv) == 2:
         initiateDownload(pageId)
+        if METRICS_EXPORTER is not None and metrics_file:
+            METRICS_EXPORTER.writeSnapshot()
     elif len(sys.argv) == 4:
-        os.chdir(getPageId(pageId))
-        try:
-            logging.basicConfig(filename='server.log', encoding='utf-8', level=logging.DEBUG,  format='%(asctime)s %(levelname)-8s %(message)s',datefmt='%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            logging.basicConfig(filename='server.log', level=logging.DEBUG,  format='%(asctime)s %(levelname)-8s %(message)s',datefmt='%Y-%m-%d %H:%M:%S')
+        GRAPH_DATA_REQ = readGraphReqs(GRAPH_POSTS_DIR, pageId)
+        pack_path = None
+        server_log = 'server.log'
+        if os.path.isdir(getPageId(pageId)):
+            os.chdir(getPageId(pageId))
+        elif os.path.isfile(f"{getPageId(pageId)}.zip"): #serve a --pack archive without unpacking it
+            pack_path = f"{getPageId(pageId)}.zip"
+            server_log = f"{getPageId(pageId)}.server.log"
+        else:
+            print(f"No archive found for {getPageId(pageId)}, download it first")
+            sys.exit(1)
+        # request threads only queue log records, the file is written by the listener thread
+        log_handler = logging.FileHandler(server_log, encoding='utf-8')
+        log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+        log_queue = queue.SimpleQueue()
+        logging.handlers.QueueListener(log_queue, log_handler).start()
+        logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+        logging.getLogger().setLevel(LOG_LEVEL)
         logging.info("Server started up")
         print ("View in browser: http://" + sys.argv[2] + ":" + sys.argv[3])
-        httpd = HTTPServer((sys.argv[2], int(sys.argv[3])), OurSimpleHTTPRequestHandler)
+        httpd = ReplayServer((sys.argv[2], int(sys.argv[3])), OurSimpleHTTPRequestHandler, graph_names=GRAPH_DATA_REQ.keys(), pack_path=pack_path)
+        if hasattr(signal, "SIGHUP"): #kill -HUP to pick up files added to the archive while serving
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=httpd.reload, daemon=True).start())
         httpd.serve_forever()
     else:
-        print (f"Usage:\n\tFirst Download: matterport-dl.py [url_or_page_id]\n\tThen launch the server 'matterport-dl.py [url_or_page_id] 127.0.0.1 8080' and open http://127.0.0.1:8080 in a browser\n\t--proxy 127.0.0.1:1234 -- to have it use this web proxy\n\t--advanced-download -- Use this option to try and download the cropped files for dollhouse/floorplan support")
+        print (f"Usage:\n\tFirst Download: matterport-dl.py [url_or_page_id]\n\tMany tours: matterport-dl.py --batch urls.txt (one url or page id per line, --parallel-tours 4 at once)\n\tThen launch the server 'matterport-dl.py [url_or_page_id] 127.0.0.1 8080' and open http://127.0.0.1:8080 in a browser\n\t--proxy 127.0.0.1:1234 -- to have it use this web proxy\n\t--pool-size 32 -- number of keep-alive connections kept open per host\n\t--engine async -- overlap all download phases under one scheduler (--max-in-flight 64 total, --per-host 16 per host)\n\t--max-tile-resolution 2k -- don't download sweep tiles above this resolution (512, 1k, 2k or 4k)\n\t--refresh -- update an existing archive, only files that changed upstream (and new sweeps/textures) are downloaded again\n\t--verify -- check the jpg/dam files of an existing archive first and download any corrupt, partial or deleted ones again\n\t--pack -- also write the finished archive into one [page_id].zip, the server uses it when the [page_id] folder is not there\n\t--optimize-tiles -- losslessly recompress the downloaded tiles/textures with jpegtran (if installed) and hardlink identical ones together\n\t--tile-variants webp,avif -- also write these versions of the tiles (needs pillow) for the server to send browsers that accept them\n\t--no-compress -- don't write .gz/.br copies of the text files for the server to send compressed\n\t--no-validate -- don't check downloaded jpg/dam files look complete before keeping them\n\t--key-lifetime 1200 -- fetch fresh cdn access keys after this many seconds instead of waiting for them to expire mid run\n\t--retries 4 -- how many times to retry a request after connection errors, timeouts or throttling (with backoff)\n\t--static-cache DIR -- keep one shared copy of the static assets every tour uses in DIR and hardlink them into each tour (default static_cache in batch mode)\n\t--log-level INFO -- how much goes in run_report.log/server.log, DEBUG logs every file\n\t--metrics-port 9100 -- serve Prometheus metrics for the running downloads on this port of localhost (0.0.0.0:9100 for every interface)\n\t--metrics-file metrics.json -- rewrite a json snapshot of the running downloads' metrics every --metrics-interval 10 seconds\n\t--advanced-download -- Use this option to try and download the cropped files for dollhouse/floorplan support")
@@ -0,0 +1,125 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+# the downloader has a dash in its file name so it can't be imported the normal way
+spec = importlib.util.spec_from_file_location("matterport_dl", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "matterport-dl.py"))
+mpdl = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = mpdl
+spec.loader.exec_module(mpdl)
+
+TILE_URL = "https://cdn-1.matterport.com/models/abc/assets/~/tiles/s1/2k_face0_0_0.jpg?t=2-old-0&imageopt=1"
+
+def httpError(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(f"{status_code} error", response=response)
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeTransport:
+    # hands out keys from files?type=N and only serves cdn urls signed with one of the valid keys
+    def __init__(self, keys, valid_keys):
+        self.keys = keys
+        self.valid_keys = valid_keys
+        self.key_fetches = 0
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, log=None, metrics=None, **kwargs):
+        with self.lock:
+            self.key_fetches += 1
+        return FakeResponse(" ".join(f'"https://x/?{key}"' for key in self.keys))
+
+    def fetchToFile(self, url, file, post_data=None, log=None, metrics=None, headers=None, validators=None):
+        with self.lock:
+            self.fetched.append(url)
+        if not any(key in url for key in self.valid_keys):
+            raise httpError(403)
+        with open(file, "wb") as f:
+            f.write(b"tile")
+        return 4, "hash", None, None
+
+class AccessKeyManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def tour(self, transport):
+        tour = mpdl.TourDownloader("pg1", self.tmp.name, transport=transport, scheduler=mpdl.ThreadedScheduler(1), show_progress=False)
+        mpdl.makeDirs(tour.page_root)
+        tour.manifest = mpdl.DownloadManifest(tour.path(mpdl.MANIFEST_NAME))
+        self.addCleanup(tour.manifest.close)
+        tour.metrics = mpdl.RunMetrics(tour.pageid)
+        return tour
+
+    def testLogIsNotTakenForMinAge(self):
+        tour = self.tour(FakeTransport(["t=2-new-0"], ["t=2-new-0"]))
+        self.assertIs(tour.access_keys.log, tour.log)
+        self.assertIsInstance(tour.access_keys.min_age, (int, float))
+
+    def testExpiredKeyIsRefreshedAndRetried(self):
+        transport = FakeTransport(["t=2-old-0"], ["t=2-new-0"])
+        tour = self.tour(transport)
+        tour.access_keys.refresh()
+        tour.access_keys.fetched = time.time() - 60 #old enough for a 403 to mean expiry
+        transport.keys = ["t=2-new-0"]
+        self.assertEqual(tour.downloadFile(TILE_URL, "models/abc/tiles/s1/2k_face0_0_0.jpg"), "ok")
+        self.assertEqual(transport.key_fetches, 4) #the first refresh and the one after the 403, each asks files?type=3 and 2
+        self.assertIn("t=2-new-0", transport.fetched[-1])
+        self.assertEqual(tour.access_keys.keys, ["t=2-new-0"])
+
+    def testForbiddenWithFreshKeysIsAPlainFailure(self):
+        transport = FakeTransport(["t=2-new-0"], [])
+        tour = self.tour(transport)
+        tour.access_keys.refresh()
+        with self.assertRaises(mpdl.DownloadError) as caught:
+            tour.downloadFile(TILE_URL, "models/abc/tiles/s1/2k_face0_0_0.jpg")
+        self.assertEqual(caught.exception.status_code, 403)
+        self.assertEqual(transport.key_fetches, 2) #no refresh beyond the first
+        self.assertEqual(len(transport.fetched), 1)
+
+    def testStillForbiddenAfterRefreshIsAPlainFailure(self):
+        transport = FakeTransport(["t=2-old-0"], [])
+        tour = self.tour(transport)
+        tour.access_keys.refresh()
+        tour.access_keys.fetched = time.time() - 60
+        transport.keys = ["t=2-new-0"]
+        for i in range(3):
+            with self.assertRaises(mpdl.DownloadError):
+                tour.downloadFile(TILE_URL.replace("face0", f"face{i}"), f"models/abc/tiles/s1/2k_face{i}_0_0.jpg")
+        self.assertEqual(transport.key_fetches, 4) #one expiry refresh, the later 403s come with fresh keys
+
+    def testConcurrentExpiriesShareOneRefresh(self):
+        refreshes = []
+        gate = threading.Event()
+        def fetchKeys():
+            refreshes.append(1)
+            gate.wait(1)
+            return [f"t=2-k{len(refreshes)}-0"]
+        keys = mpdl.AccessKeyManager(fetchKeys, 1200, min_age=0)
+        keys.refresh()
+        gate.clear()
+        generation = keys.sign(TILE_URL)[1]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(keys.refresh(generation))) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(refreshes), 2)
+        self.assertEqual(results, [True] * 8)
+        self.assertIn("t=2-k2-0", keys.sign(TILE_URL)[0])
+
+if __name__ == "__main__":
+    unittest.main()